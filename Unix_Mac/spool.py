@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+# Copyright 2012 Digiknit Ltd (mike@digiknit.com)
+
+# GNU Copyleft Statement
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage:
+#        spool.py [-h] -d SPOOL [-c CONFIG] [-p PREFIX] [-s SUFFIX] [-j JOBS]
+#                 [-i INTERVAL] [-1] [-v]
+#
+# Spool directory worker. Watches SPOOL for job files, claims each one by
+# renaming it into SPOOL/work, and runs emboss.py for it on a pool of worker
+# processes. Several workers, on one machine or several, can share a spool.
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -d SPOOL, --spool SPOOL
+#                         the spool directory to watch
+#   -c CONFIG, --config CONFIG
+#                         config file for jobs which don't name one
+#   -p PREFIX, --prefix PREFIX
+#                         prefix file for jobs which don't name one
+#   -s SUFFIX, --suffix SUFFIX
+#                         suffix file for jobs which don't name one
+#   -j JOBS, --jobs JOBS  number of jobs to generate at once (default: one per
+#                         CPU)
+#   -i INTERVAL, --interval INTERVAL
+#                         seconds between looks at the spool directory
+#   -1, --once            exit once the spool directory is empty
+#   -v, --verbose         set verbosity -v -vv -vvv etc
+#
+# A job is a file NAME.json in the spool directory, e.g.
+#     { "image": "order1234.png", "args": [ "--zsmooth", "--height", "30", "cylinder", "--radius", "20" ] }
+# "args" are the emboss.py options and shape, without --image, --output, --preview or the sweep
+# options, nor any abbreviation of them. "config", "prefix" and "suffix" may also be given. File names are relative to the spool directory. Write the image
+# first and the job file last (or write it under a name starting with "." and rename it into place).
+#
+# SPOOL/work/   jobs being generated, with their output and log so far
+# SPOOL/done/   NAME.json, NAME.log and the finished NAME.bfb (and NAME.bfb.idx with --index), or
+#               NAME.bfb.gz or NAME.bin with --format gzip or binary
+# SPOOL/failed/ the same, for jobs which failed; NAME.log says why
+#
+# Each image is decoded and preprocessed only once, however many of the worker's processes need it:
+# the first saves the height map in a directory of its own under SPOOL/work (as emboss.py --cache
+# would) and the rest memory map that one copy. A height map is deleted once no running job uses its
+# image, and the directory when the worker exits. Jobs whose "args" give their own --cache keep their
+# height maps there.
+
+# Usage example
+# ./spool.py --spool /srv/emboss --jobs 4
+
+import argparse
+import errno
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import time
+import traceback
+import emboss
+
+stopping = False
+
+# Options which would take the job's output away from the spool, however argparse is given them
+blocked_options       = [ "--image", "--output", "--preview", "--sweep-emboss", "--sweep-layer", "--sweep-output" ]
+blocked_short_options = "io"
+short_flags           = "vzax"  # Short options of emboss.py which take no value, so can be run together
+
+output_suffixes = { 'text': ".bfb", 'gzip': ".bfb.gz", 'binary': ".bin" }   # For each emboss.py --format
+
+def getConfigFromArgs():
+    global args
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="""
+        Watch a spool directory for jobs, claim them safely alongside other workers and generate them
+        in parallel, moving each job and its output to done or failed.
+    """)
+
+    parser.add_argument("-d", "--spool", dest="spool", required=True, help="the spool directory to watch")
+
+    parser.add_argument("-c", "--config", dest="config", default=os.path.join(here, "BfB3000_config.txt"), help="config file for jobs which don't name one")
+    parser.add_argument("-p", "--prefix", dest="prefix", default=os.path.join(here, "BfB3000_prefix.txt"), help="prefix file for jobs which don't name one")
+    parser.add_argument("-s", "--suffix", dest="suffix", default=os.path.join(here, "BfB3000_suffix.txt"), help="suffix file for jobs which don't name one")
+
+    parser.add_argument("-j", "--jobs", type=int, dest="jobs", help="number of jobs to generate at once (default: one per CPU)", default=multiprocessing.cpu_count())
+    parser.add_argument("-i", "--interval", type=float, dest="interval", help="seconds between looks at the spool directory", default=2.0)
+    parser.add_argument("-1", "--once", action="store_true", dest="once", help="exit once the spool directory is empty", default=False)
+
+    parser.add_argument("-v", "--verbose", action="count", dest="verbose", help="set verbosity -v -vv -vvv etc", default=0)
+
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        print "Aborted."
+        print "If specified, jobs (%d) must be at least 1." % ( args.jobs )
+        exit(1)
+
+    for d in [ "work", "done", "failed" ]:
+        path = os.path.join( args.spool, d )
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+
+def stop(signum=None, frame=None):
+    "Stop claiming jobs, and exit once those already claimed are finished"
+    global stopping
+    stopping = True
+
+def initWorker():
+    # Interrupts are for the scanning process, which lets the jobs in hand finish
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+    signal.signal( signal.SIGTERM, signal.SIG_DFL )
+
+def findJobs():
+    "Returns the names of the jobs waiting in the spool directory, oldest first"
+
+    jobs = []
+    for filename in os.listdir( args.spool ):
+        name, ext = os.path.splitext( filename )
+        if ext == ".json" and not name.startswith( "." ):
+            path = os.path.join( args.spool, filename )
+            try:
+                jobs.append( ( os.path.getmtime( path ), name ) )
+            except OSError:
+                continue    # Claimed by another worker meanwhile
+    return [ name for mtime, name in sorted( jobs ) ]
+
+def claimJob(name):
+    "Moves a job into the work directory. Only one worker's rename can succeed."
+
+    try:
+        os.rename( os.path.join( args.spool, name + ".json" ), os.path.join( args.spool, "work", name + ".json" ) )
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return True
+
+def isBlockedOption(option):
+    "Returns whether argparse could take option as one of the blocked options"
+
+    if option.startswith( "--" ):
+        # Any prefix of a long option will do, with or without =VALUE
+        name = option.split( "=" )[0]
+        return len( [ blocked for blocked in blocked_options if blocked.startswith( name ) ] ) > 0
+    if option.startswith( "-" ):
+        # Short options can be run together (-vo FILE) or have their value attached (-oFILE)
+        for c in option[1:]:
+            if c in blocked_short_options:
+                return True
+            if c not in short_flags:
+                break
+    return False
+
+def getJobArgv(spool, name, defaults):
+    "Returns the emboss.py command line for a job"
+
+    job = json.load( open( os.path.join( spool, "work", name + ".json" ) ) )
+
+    options = job.get( "args", [] )
+    for option in options:
+        if isBlockedOption( option ):
+            raise ValueError( "job args may not include %s" % ( option ) )
+
+    # Share height maps with the other jobs, unless the job has its own cache
+    argv = [ "--cache", defaults['cache'] ]
+    for key in [ "config", "prefix", "suffix" ]:
+        argv = argv + [ "--" + key, os.path.join( spool, job[key] ) if key in job else defaults[key] ]
+
+    return argv + [ "--image",  os.path.join( spool, job["image"] ),
+                    "--output", os.path.join( spool, "work", name + ".bfb" ) ] + options
+
+def getJobImage(name):
+    "Returns the image a claimed job uses, or None if it can't be read"
+    try:
+        return json.load( open( os.path.join( args.spool, "work", name + ".json" ) ) ).get( "image" )
+    except Exception:
+        return None
+
+def runJob(spool, name, defaults):
+    "Generates one claimed job in a worker process, returning its name, status, time, output size and suffix, and height map"
+
+    start = time.time()
+    status = 1
+
+    stderr = sys.stderr
+    sys.stderr = open( os.path.join( spool, "work", name + ".log" ), 'w' )
+    emboss.args = None
+    emboss.heightmapPath = None
+    try:
+        try:
+            emboss.main( getJobArgv( spool, name, defaults ) )
+            status = 0
+        except SystemExit, e:
+            if isinstance( e.code, str ):
+                print >> sys.stderr, e.code
+                status = 1
+            else:
+                status = e.code or 0
+        except Exception:
+            traceback.print_exc()
+    finally:
+        # emboss.main() leaves the output as sys.stdout if it stops early
+        if ( emboss.args != None ) and ( emboss.args.fh_output != None ):
+            emboss.args.fh_output.close()
+        sys.stdout = sys.__stdout__
+
+        # emboss.py reports invalid options at the end of its output, so copy them into the log
+        output = os.path.join( spool, "work", name + ".bfb" )
+        if ( status != 0 ) and os.path.exists( output ):
+            print >> sys.stderr, "emboss.py stopped with status %s. Its output ended:" % ( status )
+            sys.stderr.writelines( open( output ).readlines()[-5:] )
+
+        # A job which writes no Gcode has failed, whatever its status
+        size = os.path.getsize( output ) if os.path.exists( output ) else 0
+        if ( status == 0 ) and ( size == 0 ):
+            print >> sys.stderr, "emboss.py finished without writing any output."
+            status = 1
+
+        sys.stderr.close()
+        sys.stderr = stderr
+
+    suffix = output_suffixes[emboss.args.format] if emboss.args != None else ".bfb"
+
+    return ( name, status, time.time() - start, size, suffix, emboss.heightmapPath )
+
+def finishJob(name, status, suffix):
+    "Moves a job, its log and its output from work to done, or to failed, naming the output for its format"
+
+    destination = "done" if status == 0 else "failed"
+    output = os.path.join( args.spool, "work", name + ".bfb" )
+
+    for ext in [ ".json", ".log" ]:
+        path = os.path.join( args.spool, "work", name + ext )
+        if os.path.exists( path ):
+            os.rename( path, os.path.join( args.spool, destination, name + ext ) )
+
+    # The index names the output, so point it at where the output is going
+    index = output + ".idx"
+    if os.path.exists( index ):
+        text = open( index ).read().replace( json.dumps( output ), json.dumps( os.path.join( args.spool, destination, name + suffix ) ), 1 )
+        fh = open( os.path.join( args.spool, destination, name + suffix + ".idx" ), 'w' )
+        fh.write( text )
+        fh.close()
+        os.remove( index )
+
+    # Rename the output last, so that anything watching done never sees a job half moved
+    if os.path.exists( output ):
+        os.rename( output, os.path.join( args.spool, destination, name + suffix ) )
+
+def releaseHeightMaps(image, running):
+    "Deletes the height maps made from an image, unless a running job is still using it"
+
+    if image in [ i for r, i in running ]:
+        return
+    for path in heightmaps.pop( image, [] ):
+        try:
+            os.remove( path )
+        except OSError:
+            pass    # Still mapped, on a system which won't delete open files
+
+def reportStats(start, done, failed, busy, size):
+    elapsed = time.time() - start
+    jobs = done + failed
+
+    print "%d job(s) done, %d failed in %.1fs: %.1f jobs/min, %.2f MB/s of output, %.1fs per job, workers %.0f%% busy" % (
+        done, failed, elapsed, 60.0 * jobs / max( elapsed, 1e-6 ), size / 1e6 / max( elapsed, 1e-6 ),
+        busy / max( jobs, 1 ), 100.0 * busy / max( elapsed * args.jobs, 1e-6 ) )
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    getConfigFromArgs()
+
+    defaults = { 'config': args.config, 'prefix': args.prefix, 'suffix': args.suffix,
+                 'cache': os.path.join( args.spool, "work", ".heightmaps.%s.%d" % ( socket.gethostname(), os.getpid() ) ) }
+    os.mkdir( defaults['cache'] )
+    heightmaps = {}
+
+    pool = multiprocessing.Pool( args.jobs, initWorker )
+
+    signal.signal( signal.SIGINT,  stop )
+    signal.signal( signal.SIGTERM, stop )
+
+    start = time.time()
+    running = []
+    done = failed = 0
+    busy = 0.0
+    size = 0
+
+    while True:
+        # Claim only as many jobs as there are free workers, leaving the rest for other workers
+        if not stopping:
+            for name in findJobs()[:args.jobs - len(running)]:
+                if claimJob( name ):
+                    if args.verbose > 0:
+                        print "claimed %s" % ( name )
+                    running.append( ( pool.apply_async( runJob, ( args.spool, name, defaults ) ), getJobImage( name ) ) )
+
+        if not running and ( stopping or args.once ):
+            break
+
+        time.sleep( 0.1 if running else args.interval )
+
+        for result, image in [ ( r, i ) for r, i in running if r.ready() ]:
+            running.remove( ( result, image ) )
+            name, status, elapsed, length, suffix, heightmap = result.get()
+            finishJob( name, status, suffix )
+
+            # Height maps in a job's own --cache are the job's to keep
+            if heightmap != None and os.path.dirname( heightmap ) == defaults['cache']:
+                heightmaps.setdefault( image, set() ).add( heightmap )
+            releaseHeightMaps( image, running )
+
+            if status == 0:
+                done = done + 1
+                size = size + length
+                print "done    %-30s %7.1fs %10d bytes" % ( name, elapsed, length )
+            else:
+                failed = failed + 1
+                print "FAILED  %-30s %7.1fs  see %s" % ( name, elapsed, os.path.join( args.spool, "failed", name + ".log" ) )
+            busy = busy + elapsed
+
+            if args.verbose > 0:
+                reportStats( start, done, failed, busy, size )
+            sys.stdout.flush()
+
+    pool.close()
+    pool.join()
+    shutil.rmtree( defaults['cache'], ignore_errors=True )
+
+    reportStats( start, done, failed, busy, size )
@@ -63,6 +63,64 @@ failures=`cat << !EOF
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png cone --rbot 25 --rtop 25.1 >/dev/null
 [ ! "Cone top radius << bottom radius - excessive overhangs" ]
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --height 10 cone --rbot 50.00 --rtop 5.00 >/dev/null
+[ ! "Unknown progress format" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --progress xml cylinder >/dev/null
+[ ! "Zero adaptive min layer" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --adaptive --min-layer 0 cylinder >/dev/null
+[ ! "Adaptive min layer > max layer" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --adaptive --min-layer 0.4 --max-layer 0.3 cylinder >/dev/null
+[ ! "Adaptive max layer > extrusion width" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --adaptive --max-layer 1.0 cylinder >/dev/null
+[ ! "Bad levels" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --levels 200,100 cylinder >/dev/null
+[ ! "Zero gamma" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --gamma 0 cylinder >/dev/null
+[ ! "Negative blur" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --blur -1 cylinder >/dev/null
+[ ! "One dither level" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --dither 1 cylinder >/dev/null
+[ ! "Missing cache directory" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --cache ./cache.err cylinder >/dev/null
+[ ! "Index without an output file" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --index cylinder >/dev/null
+[ ! "Zero start layer" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --start-layer 0 cylinder >/dev/null
+[ ! "Start layer beyond the top" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --start-layer 1000 cylinder >/dev/null
+[ ! "Chord shorter than the extrusion width" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --chord 0.1 cylinder >/dev/null
+[ ! "Sweep without an output template" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --sweep-emboss 0.4,0.8 cylinder >/dev/null
+[ ! "Sweep template without placeholders" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --sweep-emboss 0.4,0.8 --sweep-output ./s_cylinder.bfb cylinder >/dev/null
+[ ! "Sweep emboss factor out of range" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --sweep-emboss 0.1,0.8 --sweep-output ./s_{emboss}.bfb cylinder >/dev/null
+[ ! "Spool worker without any workers" ]
+./spool.py --spool /tmp/emboss_spool --jobs 0 >/dev/null
+[ ! "Raft pitch less than the extrusion width" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --raft-pitch 0.2 cylinder >/dev/null
+[ ! "Preview with checksums" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --preview /tmp/p_cylinder --checksum cylinder >/dev/null
+[ ! "Binary output with an index" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --format binary --index --output /tmp/z_cylinder.bin cylinder >/dev/null
+[ ! "Decoding a file which emboss.py didn't write" ]
+./decode.py ./bfblogo.png >/dev/null
+[ ! "Negative write buffers" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --write-buffers -1 cylinder >/dev/null
+[ ! "Time budget too short for the object" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --time-budget 0.1 cylinder >/dev/null
+[ ! "Time budget with adaptive layers" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --time-budget 2 --adaptive cylinder >/dev/null
+[ ! "Progress to a file descriptor which isn't open" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --progress json --progress-fd 9 cylinder >/dev/null
+[ ! "Progress on standard output along with the Gcode" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --progress json --progress-fd 1 cylinder >/dev/null
+[ ! "Missing profile file" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png profile >/dev/null
+[ ! "Incorrect profile file" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png profile --file ./vase.err >/dev/null
+[ ! "Profile shorter than the object" ]
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --height 50 profile --file ./vase.csv >/dev/null
 
 !EOF`
 
@@ -70,8 +128,29 @@ successes=`cat << !EOF
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./c_cylinder.bfb  --zsmooth        cylinder --radius 20.0
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./c_cone.bfb      --zsmooth        cone     --rbot 30.0 --rtop 20.0
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./c_globe.bfb     --zsmooth        globe
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./a_globe.bfb     --zsmooth --adaptive globe
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./h_globe.bfb     --zsmooth --chord 1.0 globe
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --sweep-emboss 0.4,0.8 --sweep-layer 0.2,0.25 --sweep-output ./s_cylinder_{emboss}_{layer}.bfb cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --sweep-emboss 0.5 --sweep-layer 0.25,0.3 --sweep-output ./s1_cylinder_{emboss}_{layer}.bfb cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./s1_cylinder.bfb --embossFactor 0.5 cylinder && cmp ./s1_cylinder.bfb ./s1_cylinder_0.5_0.25.bfb
+rm -rf /tmp/emboss_spool1 && mkdir /tmp/emboss_spool1 && cp ./bfblogo.png /tmp/emboss_spool1 && echo '{ "image": "bfblogo.png", "args": [ "--index", "cylinder" ] }' > /tmp/emboss_spool1/j1.json && ./spool.py --spool /tmp/emboss_spool1 --jobs 1 --once >/dev/null && test -s /tmp/emboss_spool1/done/j1.bfb && grep -q done/j1.bfb /tmp/emboss_spool1/done/j1.bfb.idx && test -f /tmp/emboss_spool1/done/j1.json
+rm -rf /tmp/emboss_spool2 && mkdir /tmp/emboss_spool2 && cp ./bfblogo.png /tmp/emboss_spool2 && echo '{ "image": "bfblogo.png", "args": [ "--format", "gzip", "cylinder" ] }' > /tmp/emboss_spool2/j2.json && ./spool.py --spool /tmp/emboss_spool2 --jobs 1 --once >/dev/null && gzip -t /tmp/emboss_spool2/done/j2.bfb.gz
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./c_vase.bfb      --zsmooth        profile  --file ./vase.csv
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./b2_cylinder.bfb --bottomLayers 2 cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./x_cylinder.bfb --index cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./r_cylinder.bfb --bottomLayers 2 --start-layer 100 cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./n_cylinder.bfb --bottomLayers 2 --checksum cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./k_cylinder.bfb --bottomLayers 2 --raft skirt cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output /dev/null         --raft base --raft-pitch 6 cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --preview ./p_globe               --zsmooth        globe
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./z_globe.bfb.gz --zsmooth --format gzip globe
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./z_cylinder.bin --bottomLayers 2 --format binary cylinder
+./decode.py --output /dev/null ./z_cylinder.bin
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output /dev/null         --write-buffers 4 --checksum cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./t_globe.bfb     --zsmooth --time-budget 0.5 globe
 ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output /dev/null         -v               cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output /dev/null         --progress json  cylinder
+./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output /dev/null           --levels 20,230 --gamma 1.4 --blur 2 --sharpen 0.5 --dither 8 --cache /tmp globe
 !EOF`
 
 echo -e "\nExpected Failure scenarios"
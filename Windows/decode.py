@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# Copyright 2012 Digiknit Ltd (mike@digiknit.com)
+
+# GNU Copyleft Statement
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage:
+#        decode.py [-h] [-o [FH_OUTPUT]] fh_input
+#
+# Turn the output of emboss.py --format gzip or --format binary back into Gcode
+# text.
+#
+# positional arguments:
+#   fh_input              the gzip or binary file written by emboss.py
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -o [FH_OUTPUT], --output [FH_OUTPUT]
+#                         the Gcode file to write (default: standard output)
+
+# Usage example
+# ./decode.py --output ./c_globe.bfb ./z_globe.bin
+
+import argparse
+import gzip
+import shutil
+import struct
+import sys
+import numpy
+import emboss
+
+decode_chunk = 1 << 20  # Bytes of input to decode at a time
+
+def getConfigFromArgs():
+    global args
+
+    parser = argparse.ArgumentParser(description="""
+        Turn the output of emboss.py --format gzip or --format binary back into Gcode text.
+    """)
+
+    parser.add_argument("fh_input", type=argparse.FileType('rb'), help="the gzip or binary file written by emboss.py")
+    parser.add_argument("-o", "--output", dest="fh_output", default=sys.stdout, nargs='?', type=argparse.FileType('w'), help="the Gcode file to write (default: standard output)")
+
+    args = parser.parse_args()
+
+def getValues(fixed, scale):
+    "Returns a list of the values of a field of the move records"
+    values = fixed / float( scale )
+    values[ fixed == emboss.BinaryWriter.negative_zero ] = -0.0
+    return values.tolist()
+
+def decodeRecords(data, output):
+    "Writes the text of the complete records at the start of data, returning how many bytes they took"
+
+    size = emboss.BinaryWriter.move.itemsize
+    pos = 0
+    while pos < len(data):
+        op = data[pos]
+        if op == "M":
+            # Moves come in long runs, so find where the run ends and format it all at once
+            count = ( len(data) - pos ) // size
+            ops = numpy.frombuffer( data, numpy.uint8, count * size, pos )[::size]
+            moves = ( ops == ord("M") )
+            run = count if moves.all() else int( numpy.argmin( moves ) )
+            if run == 0:
+                break
+            moves = numpy.frombuffer( data, emboss.BinaryWriter.move, run, pos )
+            output.write( "".join( [ "G1 X%.2f Y%.2f Z%.2f F%.1f\n" % move for move in zip(
+                getValues( moves['x'], 100 ), getValues( moves['y'], 100 ), getValues( moves['z'], 100 ), getValues( moves['f'], 10 ) ) ] ) )
+            pos = pos + run * size
+        elif op in "TC":
+            if pos + 3 > len(data):
+                break
+            length = struct.unpack_from( "<H", data, pos + 1 )[0]
+            if pos + 3 + length > len(data):
+                break
+            # A 'C' record's text carries on in the next record, so isn't the end of a line
+            output.write( data[pos+3:pos+3+length] + ( "\n" if op == "T" else "" ) )
+            pos = pos + 3 + length
+        else:
+            raise ValueError( "unknown record type %r at byte %d of this chunk" % ( op, pos ) )
+    return pos
+
+def decode(fh, output):
+    "Decodes a binary move file, a chunk at a time"
+
+    data = ""
+    while True:
+        chunk = fh.read( decode_chunk )
+        if not chunk:
+            break
+        data = data + chunk
+        data = data[decodeRecords( data, output ):]
+
+    if data:
+        raise ValueError( "the file ends part way through a record" )
+
+if __name__ == '__main__':
+    getConfigFromArgs()
+
+    fh = args.fh_input
+    if fh.read(2) == "\x1f\x8b":
+        fh.seek(0)
+        fh = gzip.GzipFile( fileobj=fh, mode='rb' )
+    else:
+        fh.seek(0)
+
+    try:
+        magic = fh.read( len( emboss.binary_magic ) )
+        if magic == emboss.binary_magic:
+            decode( fh, args.fh_output )
+        elif fh != args.fh_input:
+            # Compressed text needs only decompressing
+            args.fh_output.write( magic )
+            shutil.copyfileobj( fh, args.fh_output, decode_chunk )
+        else:
+            print "Aborted."
+            print "%s is neither gzip compressed nor binary output from emboss.py." % ( args.fh_input.name )
+            exit(1)
+    except ( IOError, ValueError ), msg:
+        print "Aborted."
+        print "%s can't be decoded: %s." % ( args.fh_input.name, msg )
+        exit(1)
+
+    args.fh_output.close()
@@ -24,14 +24,23 @@
 # Usage:
 #        emboss.py [-h] -i FH_IMAGE -c FH_CONFIG -p FH_PREFIX -s FH_SUFFIX
 #                  [-o [FH_OUTPUT]] [-H HEIGHTMM] [-z] [-l BOTTOMLAYERS]
-#                  [-e EMBOSSFACTOR] [-v]
-#                  {cylinder,cone,globe} ...
+#                  [-e EMBOSSFACTOR] [--progress {text,json}]
+#                  [--progress-fd PROGRESS_FD] [-a] [--min-layer MINLAYERMM]
+#                  [--max-layer MAXLAYERMM] [--levels LO,HI] [--gamma GAMMA]
+#                  [--blur BLUR] [--sharpen SHARPEN] [--dither DITHER]
+#                  [--cache CACHE] [-x] [--start-layer STARTLAYER]
+#                  [--chord CHORDMM] [--sweep-emboss LIST] [--sweep-layer LIST]
+#                  [--sweep-output TEMPLATE] [--checksum]
+#                  [--raft {full,base,skirt}] [--raft-pitch BASE[,INTERFACE]]
+#                  [--time-budget HOURS] [--format {text,gzip,binary}]
+#                  [--write-buffers N] [--preview PREFIX] [-v]
+#                  {cylinder,cone,globe,profile} ...
 # 
 # Programatically generate Gcode for an embossed object using a supplied image
 # to modulate the amount of plastic extruded at each location.
 # 
 # positional arguments:
-#   {cylinder,cone,globe}
+#   {cylinder,cone,globe,profile}
 # 
 # optional arguments:
 #   -h, --help            show this help message and exit
@@ -48,37 +57,172 @@
 #   -e EMBOSSFACTOR, --embossFactor EMBOSSFACTOR
 #                         minumum ratio of embossing feed rate over normal feed
 #                         rate
+#   --progress {text,json}
+#                         report layer progress, lines/sec and ETA as text or
+#                         JSON lines
+#   --progress-fd PROGRESS_FD
+#                         file descriptor for progress reports (default 2,
+#                         stderr)
+#   -a, --adaptive        choose each layer height from the shape's slope and
+#                         the image's vertical detail
+#   --min-layer MINLAYERMM
+#                         thinnest adaptive layer in mm (default: the configured
+#                         layer_height)
+#   --max-layer MAXLAYERMM
+#                         thickest adaptive layer in mm (default: twice the
+#                         configured layer_height)
+#   --levels LO,HI        stretch image luminance between these black and white
+#                         points (0-255)
+#   --gamma GAMMA         apply a gamma correction to the image (>1 brightens)
+#   --blur BLUR           blur the image with this radius in pixels
+#   --sharpen SHARPEN     sharpen the image by this amount (unsharp mask)
+#   --dither DITHER       dither the image down to this many grey levels
+#   --cache CACHE         directory in which to keep preprocessed height maps
+#   -x, --index           write OUTPUT.idx, giving the byte offset and Z of
+#                         every section and layer of the output
+#   --start-layer STARTLAYER
+#                         resume a failed print: generate only the shape from
+#                         this layer upwards
+#   --chord CHORDMM       target length in mm of each move around a layer, so
+#                         that the segments per layer follow its circumference
+#                         rather than the image width
+#   --sweep-emboss LIST   comma separated emboss factors to generate in one run
+#   --sweep-layer LIST    comma separated layer heights in mm to generate in one
+#                         run
+#   --sweep-output TEMPLATE
+#                         output file name for each sweep variant, e.g.
+#                         cal_{emboss}_{layer}.bfb
+#   --checksum            number every command and add its XOR checksum (N123
+#                         ... *45) for serial transfer, and fill in the
+#                         ^Checksum: header
+#   --raft {full,base,skirt}
+#                         print the full raft, only its base layer, or no raft
+#                         but a skirt around the object
+#   --raft-pitch BASE[,INTERFACE]
+#                         spacing in mm between the lines of each raft layer
+#                         (default: the config file's pitch, or 4 extrusion
+#                         widths)
+#   --time-budget HOURS   choose the thinnest layers with which the estimated
+#                         print time fits in HOURS, raising the emboss factor
+#                         only if even the thickest layers don't fit
+#   --format {text,gzip,binary}
+#                         write the Gcode as text, gzip compressed text, or
+#                         binary move records (see decode.py)
+#   --write-buffers N     write the output from a background thread, with up to
+#                         N buffers of output queued for it, so that generation
+#                         carries on while the output is written
+#   --preview PREFIX      instead of the Gcode, write PREFIX_unrolled.png and
+#                         PREFIX_top.png showing the shape's moves coloured by
+#                         feed rate
 #   -v, --verbose         set verbosity -v -vv -vvv etc
 
 # Usage example
 # ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./globe.png --output ./c_globe.bfb --zsmooth globe
+# ./emboss.py --config ./BfB3000_config.txt --prefix ./BfB3000_prefix.txt --suffix ./BfB3000_suffix.txt --image ./bfblogo.png --output ./c_vase.bfb --zsmooth profile --file ./vase.csv
 
 import argparse
+import collections
+import csv
+import gzip
+import hashlib
+import itertools
+import json
 import math
+import os
+import Queue
+import re
+import StringIO
+import signal
+import struct
 import sys
+import threading
+import time
+import zlib
 import Image
 import ConfigParser
+import numpy
 
 # Constants
 raft_margin = 5.00  # Margin in mm to increase raft radius beyond object boundary
+raft_patterns = [ 'zigzag', 'grid' ]    # Patterns a raft layer can be filled with
+skirt_loops = 2     # Number of loops in a skirt
+skirt_segment = 2.0 # Length in mm of each move around a skirt loop
 max_bottom  = 10    # Maximum number of bottomLayers
+progress_interval = 0.5 # Minimum time in seconds between progress reports
+adaptive_detail = 0.05  # Largest mean luminance change between image rows an adaptive layer may skip over
+heightmap_version = 1   # Change this whenever preprocessing changes, to invalidate cached height maps
+heightmap_wait = 30.0   # Longest time in seconds to wait for another process to finish a cached height map
+budget_layer_step = 0.02   # Step in mm between the layer heights --time-budget tries
+budget_emboss_step = 0.05  # Step between the emboss factors --time-budget tries
+resume_clearance = 2.00 # Height in mm above the resumed layer at which to travel to its start
+checksum_header = "^Checksum: " # Firmware header line which can carry a whole-file checksum
+gzip_level = 6      # Compression level (1 fastest - 9 smallest) of --format gzip output
+writer_buffer = 1 << 18 # Bytes of output in each buffer handed to the --write-buffers thread
+binary_magic = "BFBM\x01"  # Start of a --format binary file: "BFBM" and the format version
+preview_size = 800  # Largest width or height in pixels of a preview image
+preview_slow = ( 40, 40, 170 )  # Colour of moves at the slowest (most embossed) feed rate in a preview
+preview_fast = ( 255, 220, 60 ) # Colour of moves at the normal feed rate in a preview
 
-def init():
-    global layer, layerCount, rDeltaPerLayer, anglePerSegment, prefix, suffix
+# Progress and cancellation.
+#
+# progressCallback, if set, is called with a dict for every progress event (see reportProgress).
+# Call cancel() (or send SIGINT / SIGTERM) to stop makeShape() cleanly at the end of the current layer.
+progressCallback = None
+cancelled = False
+
+def init(argv=None):
+    global layer, rDeltaPerLayer, prefix, suffix
+    global shape, cancelled
     
-    getConfigFromArgs()
+    cancelled = False
+    getConfigFromArgs(argv)
     getConfigFromFile()
     
+    shape = shapes[args.object_type]
     validateInputs()
     
     prefix = getGcodeFromFile(args.fh_prefix)
     suffix = getGcodeFromFile(args.fh_suffix)
     getImagePixels()
+    
+    if args.timeBudget != None:
+        fitTimeBudget()
+    
+    if not sweeping():
+        makeLayerTables()
 
+def makeLayerTables():
+    global layerCount, layerRadius, layerZ, layerRise, layerRow, layerSegments
+    
     layerCount = args.heightMm / printer_layer_height
-    anglePerSegment = 2*math.pi/segments
+    
+    # The shape doesn't change from point to point, so evaluate the radius, Z, rise, image row
+    # and number of segments of every layer once, up front.
+    if args.adaptive:
+        heights = makeAdaptiveHeights()
+        reportAdaptiveHeights( heights )
+        
+        layerCount = float( len(heights) - 1 )
+        fractions  = heights / args.heightMm
+        layerZ     = ( raft_top + args.bottomLayers * printer_layer_height + heights ).tolist()
+        layerRise  = numpy.append( numpy.diff( heights ), heights[-1] - heights[-2] ).tolist()
+        layerRow   = getImageRows( heightmap.shape[0] * heights / args.heightMm )
+    else:
+        steps      = numpy.arange( int(layerCount) + 1 )
+        fractions  = steps / layerCount
+        layerZ     = ( raft_top + ( steps + args.bottomLayers ) * printer_layer_height ).tolist()
+        layerRise  = [ printer_layer_height ] * len(steps)
+        layerRow   = getImageRows( heightmap.shape[0] * steps / layerCount )
+    
+    layerRadius = shape['radius']( fractions ).tolist()
+    layerSegments = [ getSegmentCount( r ) for r in layerRadius ]
+    
+    if ( args.startLayer != None ) and ( ( args.startLayer < 1 ) or ( args.startLayer > int(layerCount) - 1 ) ):
+        print "Aborted."
+        print "If specified, start-layer (%d) must be between 1 and %d." % ( args.startLayer, int(layerCount) - 1 )
+        exit(1)
 
-def getConfigFromArgs():
+def getConfigFromArgs(argv=None):
     global args
     
     parser = argparse.ArgumentParser(description="""
@@ -88,11 +232,10 @@ def getConfigFromArgs():
     
     subparsers = parser.add_subparsers(dest='object_type')
     
-    parser_cylinder = subparsers.add_parser('cylinder')
-    parser_cone     = subparsers.add_parser('cone')
-    parser_globe    = subparsers.add_parser('globe')
+    for name, s in shapes.items():
+        s['arguments']( subparsers.add_parser(name) )
     
-    parser.add_argument("-i", "--image",  dest="fh_image",  required=True, type=argparse.FileType('r') )
+    parser.add_argument("-i", "--image",  dest="fh_image",  required=True, type=argparse.FileType('rb') )
     parser.add_argument("-c", "--config", dest="fh_config", required=True, type=argparse.FileType('r') )
     parser.add_argument("-p", "--prefix", dest="fh_prefix", required=True, type=argparse.FileType('r') )
     parser.add_argument("-s", "--suffix", dest="fh_suffix", required=True, type=argparse.FileType('r') )
@@ -104,23 +247,65 @@ def getConfigFromArgs():
     parser.add_argument("-l", "--bottomLayers",type=int, help="number of layers in the floor")    
     parser.add_argument("-e", "--embossFactor", type=float, help="minumum ratio of embossing feed rate over normal feed rate", default=0.40)
     
-    parser.add_argument("-v", "--verbose", action="count",dest="verbose", help="set verbosity -v -vv -vvv etc", default=0)
+    parser.add_argument(      "--progress", choices=['text', 'json'], dest="progress", help="report layer progress, lines/sec and ETA as text or JSON lines", default=None)
+    parser.add_argument(      "--progress-fd", type=int, dest="progress_fd", help="file descriptor for progress reports (default 2, stderr)", default=2)
     
-    parser_cylinder.add_argument("-r", "--radius", type=float, dest="radius", help="set the radius of a right cylinder in mm", default=25)
+    parser.add_argument("-a", "--adaptive", action="store_true", dest="adaptive", help="choose each layer height from the shape's slope and the image's vertical detail", default=False)
+    parser.add_argument(      "--min-layer", type=float, dest="minLayerMm", help="thinnest adaptive layer in mm (default: the configured layer_height)")
+    parser.add_argument(      "--max-layer", type=float, dest="maxLayerMm", help="thickest adaptive layer in mm (default: twice the configured layer_height)")
     
-    parser_cone.add_argument(      "--rtop", type=float, dest="rTopMm",  help="set the top radius of a cone in mm", default=10.0)
-    parser_cone.add_argument(      "--rbot", type=float, dest="rBottomMm", help="set the bottom radius of a cone in mm", default=25.0)
+    parser.add_argument(      "--levels", type=levelsArgument, dest="levels", metavar="LO,HI", help="stretch image luminance between these black and white points (0-255)", default=None)
+    parser.add_argument(      "--gamma", type=float, dest="gamma", help="apply a gamma correction to the image (>1 brightens)", default=1.0)
+    parser.add_argument(      "--blur", type=float, dest="blur", help="blur the image with this radius in pixels", default=0.0)
+    parser.add_argument(      "--sharpen", type=float, dest="sharpen", help="sharpen the image by this amount (unsharp mask)", default=0.0)
+    parser.add_argument(      "--dither", type=int, dest="dither", help="dither the image down to this many grey levels", default=0)
+    parser.add_argument(      "--cache", dest="cache", help="directory in which to keep preprocessed height maps", default=None)
     
-    parser_globe.add_argument("-r", "--radius", type=float, dest="radius", help="set the radius of a truncated globe in mm", default=25)
+    parser.add_argument("-x", "--index", action="store_true", dest="index", help="write OUTPUT.idx, giving the byte offset and Z of every section and layer of the output", default=False)
+    parser.add_argument(      "--start-layer", type=int, dest="startLayer", help="resume a failed print: generate only the shape from this layer upwards", default=None)
+    
+    parser.add_argument(      "--chord", type=float, dest="chordMm", help="target length in mm of each move around a layer, so that the segments per layer follow its circumference rather than the image width", default=None)
+    
+    parser.add_argument(      "--sweep-emboss", type=floatListArgument, dest="sweepEmboss", metavar="LIST", help="comma separated emboss factors to generate in one run", default=None)
+    parser.add_argument(      "--sweep-layer", type=floatListArgument, dest="sweepLayer", metavar="LIST", help="comma separated layer heights in mm to generate in one run", default=None)
+    parser.add_argument(      "--sweep-output", dest="sweepOutput", metavar="TEMPLATE", help="output file name for each sweep variant, e.g. cal_{emboss}_{layer}.bfb", default=None)
+    
+    parser.add_argument(      "--checksum", action="store_true", dest="checksum", help="number every command and add its XOR checksum (N123 ... *45) for serial transfer, and fill in the ^Checksum: header", default=False)
+    
+    parser.add_argument(      "--raft", choices=['full', 'base', 'skirt'], dest="raft", help="print the full raft, only its base layer, or no raft but a skirt around the object", default='full')
+    parser.add_argument(      "--raft-pitch", type=floatListArgument, dest="raftPitch", metavar="BASE[,INTERFACE]", help="spacing in mm between the lines of each raft layer (default: the config file's pitch, or 4 extrusion widths)", default=None)
+    
+    parser.add_argument(      "--time-budget", type=float, dest="timeBudget", metavar="HOURS", help="choose the thinnest layers with which the estimated print time fits in HOURS, raising the emboss factor only if even the thickest layers don't fit", default=None)
+    
+    parser.add_argument(      "--format", choices=['text', 'gzip', 'binary'], dest="format", help="write the Gcode as text, gzip compressed text, or binary move records (see decode.py)", default='text')
+    
+    parser.add_argument(      "--write-buffers", type=int, dest="writeBuffers", metavar="N", help="write the output from a background thread, with up to N buffers of output queued for it, so that generation carries on while the output is written", default=0)
+    
+    parser.add_argument(      "--preview", dest="preview", metavar="PREFIX", help="instead of the Gcode, write PREFIX_unrolled.png and PREFIX_top.png showing the shape's moves coloured by feed rate", default=None)
+    
+    parser.add_argument("-v", "--verbose", action="count",dest="verbose", help="set verbosity -v -vv -vvv etc", default=0)
     
     try:
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
     except IOError, msg:
         parser.exit(str(msg))
     
     if args.fh_output != None:
         sys.stdout = args.fh_output
     
+def levelsArgument(text):
+    try:
+        lo, hi = [ float(v) for v in text.split(',') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError( "expected two numbers, LO,HI: %r" % ( text ) )
+    return ( lo, hi )
+
+def floatListArgument(text):
+    try:
+        return [ float(v) for v in text.split(',') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError( "expected comma separated numbers: %r" % ( text ) )
+
 def getConfigFromFile():
     global comment_manufacturer,       comment_model,              comment_material
     global printer_base_feed_rate,     printer_base_move_rate,     printer_base_flow_rate
@@ -129,6 +314,8 @@ def getConfigFromFile():
     global gcode_flow_cmd,             gcode_start_cmd,            gcode_stop_cmd
     global raft_base_feed_multiplier,  raft_base_flow_multiplier,  raft_base_cruise_height
     global raft_iface_feed_multiplier, raft_iface_flow_multiplier, raft_iface_cruise_height
+    global raft_base_pitch,            raft_base_pattern
+    global raft_iface_pitch,           raft_iface_pattern
 
     # Example config file:
     #
@@ -152,11 +339,15 @@ def getConfigFromFile():
     # feed_multiplier = 0.75
     # flow_multiplier = 3.00
     # cruise_height = 0.7
+    # pitch = 2.0               (optional)
+    # pattern = zigzag          (optional)
     # 
     # [Raft_Interface]
     # feed_multiplier = 1.00
     # flow_multiplier = 1.50
     # cruise_height = 1.0
+    # pitch = 2.0               (optional)
+    # pattern = zigzag          (optional)
     # 
     
     config = ConfigParser.SafeConfigParser()
@@ -188,6 +379,15 @@ def getConfigFromFile():
     raft_iface_flow_multiplier  = config.getfloat('Raft_Interface', 'flow_multiplier')
     raft_iface_cruise_height    =  config.getfloat('Raft_Interface', 'cruise_height')
     
+    # Raft lines were always 4 extrusion widths apart before the pitch could be set
+    config.set('DEFAULT', 'pitch', str( 4 * printer_extrusion_width ) )
+    config.set('DEFAULT', 'pattern', 'zigzag')
+    
+    raft_base_pitch             = config.getfloat('Raft_Base', 'pitch')
+    raft_base_pattern           = config.get('Raft_Base', 'pattern')
+    raft_iface_pitch            = config.getfloat('Raft_Interface', 'pitch')
+    raft_iface_pattern          = config.get('Raft_Interface', 'pattern')
+    
     if args.verbose > 0:
         print >> sys.stderr, "Comments:"
         print >> sys.stderr, "          Manufacturer: " + comment_manufacturer
@@ -210,13 +410,16 @@ def getConfigFromFile():
         print >> sys.stderr, "       Feed Multiplier: %.2f\t(%.2f)" % ( raft_base_feed_multiplier, printer_base_feed_rate * raft_base_feed_multiplier)
         print >> sys.stderr, "       Flow Multiplier: %.2f\t(%.2f)" % ( raft_base_flow_multiplier, printer_base_feed_rate * raft_base_flow_multiplier)
         print >> sys.stderr, "         Cruise Height: %.2f" % ( raft_base_cruise_height)
+        print >> sys.stderr, "                 Pitch: %.2f\t(%s)" % ( raft_base_pitch, raft_base_pattern )
         print >> sys.stderr, "Raft interface:"
         print >> sys.stderr, "       Feed Multiplier: %.2f\t(%.2f)" % ( raft_iface_feed_multiplier, printer_base_feed_rate * raft_iface_feed_multiplier)
         print >> sys.stderr, "       Flow Multiplier: %.2f\t(%.2f)" % ( raft_iface_flow_multiplier, printer_base_feed_rate * raft_iface_flow_multiplier)
         print >> sys.stderr, "         Cruise Height: %.2f" % ( raft_iface_cruise_height )
+        print >> sys.stderr, "                 Pitch: %.2f\t(%s)" % ( raft_iface_pitch, raft_iface_pattern )
 
 def validateInputs():
-    global base_radius
+    global base_radius, raft_top, object_flow_rate, layer_flow_scale, progress_fh
+    global raft_base_cruise_height, raft_iface_cruise_height, raft_base_pitch, raft_iface_pitch
     if args.heightMm <= 0:
         print "Aborted."
         print "If specified, object height(%.2f) must be greater than zero." % ( args.heightMm )
@@ -242,55 +445,328 @@ def validateInputs():
         print "If specified, embossFactor (%.2f) must be between 0.25 and 1.00." % ( args.embossFactor )
         exit(1)
     
-    if args.object_type == 'cylinder':
-        base_radius = args.radius
+    if args.levels != None:
+        lo, hi = args.levels
+        if ( lo < 0 ) or ( hi > 255 ) or ( lo >= hi ):
+            print "Aborted."
+            print "If specified, levels (%.0f,%.0f) must be between 0 and 255, with the black point first." % ( lo, hi )
+            exit(1)
+    
+    if ( args.gamma <= 0 ):
+        print "Aborted."
+        print "If specified, gamma (%.2f) must be greater than zero." % ( args.gamma )
+        exit(1)
+    
+    if ( args.blur < 0 ) or ( args.sharpen < 0 ):
+        print "Aborted."
+        print "If specified, blur (%.2f) and sharpen (%.2f) must not be negative." % ( args.blur, args.sharpen )
+        exit(1)
+    
+    if ( args.dither != 0 ) and ( ( args.dither < 2 ) or ( args.dither > 256 ) ):
+        print "Aborted."
+        print "If specified, dither (%d) must be between 2 and 256 grey levels." % ( args.dither )
+        exit(1)
+    
+    if ( args.cache != None ) and not os.path.isdir( args.cache ):
+        print "Aborted."
+        print "The cache directory (%s) does not exist." % ( args.cache )
+        exit(1)
+    
+    if sweeping():
+        for e in args.sweepEmboss or []:
+            if ( e < 0.25 ) or ( e > 1.00 ):
+                print "Aborted."
+                print "Every sweep embossFactor (%.2f) must be between 0.25 and 1.00." % ( e )
+                exit(1)
+        
+        for lh in args.sweepLayer or []:
+            if ( lh <= 0 ) or ( lh > printer_extrusion_width ):
+                print "Aborted."
+                print "Every sweep layer height (%.2f) must be greater than zero and no more than the extrusion width (%.2f)." % ( lh, printer_extrusion_width )
+                exit(1)
+        
+        if ( args.sweepOutput == None ) or ( args.fh_output != None ):
+            print "Aborted."
+            print "A sweep needs --sweep-output, instead of --output."
+            exit(1)
+        
+        names = [ args.sweepOutput.format( emboss=e, layer=lh ) for e, lh in getSweepVariants() ]
+        if len( set( names ) ) != len( names ):
+            print "Aborted."
+            print "The sweep output template (%s) must include {emboss} and/or {layer} so that every variant gets its own file." % ( args.sweepOutput )
+            exit(1)
         
-        if ( args.radius < 5.00 ) or ( args.radius > printer_max_radius ):
+        if args.index or args.adaptive and args.sweepLayer:
             print "Aborted."
-            print "If specified, radius (%.2f) must be between 5.00 and %.2f." % ( args.radius, printer_max_radius )
+            print "A sweep can't be combined with --index, nor a layer height sweep with --adaptive."
             exit(1)
     
-    elif args.object_type == 'cone':
-        base_radius = args.rBottomMm
+    if ( args.preview != None ) and ( sweeping() or args.index or args.checksum ):
+        print "Aborted."
+        print "A preview can't be combined with a sweep, --index or --checksum."
+        exit(1)
+    
+    if args.timeBudget != None:
+        if args.timeBudget <= 0:
+            print "Aborted."
+            print "If specified, time-budget (%.2f) must be greater than zero." % ( args.timeBudget )
+            exit(1)
         
-        if ( args.rBottomMm < 5.00 ) or ( args.rBottomMm > printer_max_radius ):
+        if sweeping() or args.adaptive:
             print "Aborted."
-            print "If specified, rbot (%.2f) must be between 5.00 and %.2f." % ( args.rBottomMm, printer_max_radius )
+            print "A time budget chooses the layer height and emboss factor itself, so can't be combined with a sweep or --adaptive."
+            exit(1)
+    
+    if args.progress_fd == 2:
+        progress_fh = sys.stderr
+    elif args.progress != None:
+        if ( args.progress_fd == 1 ) and not sweeping() and ( ( args.fh_output == None ) or ( args.fh_output.name == '<stdout>' ) ):
+            print "Aborted."
+            print "Progress reports can't go to standard output (progress-fd 1) while the Gcode does."
             exit(1)
         
-        if ( args.rTopMm < 5.00 ) or ( args.rTopMm > printer_max_radius ):
+        try:
+            progress_fh = os.fdopen( args.progress_fd, 'w' )
+        except OSError, e:
             print "Aborted."
-            print "If specified, rtop (%.2f) must be between 5.00 and %.2f." % ( args.rTopMm, printer_max_radius )
+            print "Progress file descriptor (%d) can't be written: %s." % ( args.progress_fd, e.strerror )
+            exit(1)
+    
+    if args.writeBuffers < 0:
+        print "Aborted."
+        print "If specified, write-buffers (%d) must not be negative." % ( args.writeBuffers )
+        exit(1)
+    
+    if ( args.format != 'text' ) and ( args.index or args.checksum ):
+        print "Aborted."
+        print "An index or checksums can only be written with --format text."
+        exit(1)
+    
+    if args.index and ( args.fh_output == None ):
+        print "Aborted."
+        print "An index can only be written alongside an output file (--output)."
+        exit(1)
+    
+    if ( args.chordMm != None ) and ( args.chordMm < printer_extrusion_width ):
+        print "Aborted."
+        print "If specified, chord (%.2f) must be no less than the extrusion width (%.2f)." % ( args.chordMm, printer_extrusion_width )
+        exit(1)
+    
+    if args.minLayerMm == None:
+        args.minLayerMm = printer_layer_height
+    if args.maxLayerMm == None:
+        args.maxLayerMm = max( args.minLayerMm, 2 * printer_layer_height )
+    
+    if args.adaptive:
+        if ( args.minLayerMm <= 0 ) or ( args.minLayerMm > args.maxLayerMm ):
+            print "Aborted."
+            print "If specified, min-layer (%.2f) must be greater than zero and no more than max-layer (%.2f)." % ( args.minLayerMm, args.maxLayerMm )
             exit(1)
         
-        if ( args.rTopMm >= args.rBottomMm ):
+        if ( args.maxLayerMm > printer_extrusion_width ):
             print "Aborted."
-            print "If specified, rtop (%.2f) must be less than rbot." % ( args.rTopMm )
+            print "If specified, max-layer (%.2f) must be no more than the extrusion width (%.2f)." % ( args.maxLayerMm, printer_extrusion_width )
             exit(1)
-            
-        if ( args.heightMm / ( args.rBottomMm - args.rTopMm ) ) < math.tan(math.radians(printer_max_overhang)):
+    
+    if args.raftPitch != None:
+        if len( args.raftPitch ) > 2:
+            print "Aborted."
+            print "If specified, raft-pitch must be one or two values, for the base and interface layers."
+            exit(1)
+        raft_base_pitch  = args.raftPitch[0]
+        raft_iface_pitch = args.raftPitch[-1]
+    
+    for pitch in [ raft_base_pitch, raft_iface_pitch ]:
+        if pitch < printer_extrusion_width:
             print "Aborted."
-            print "As given, height, rtop, rbot creates an overhang angle (%.2f) less than the minimum (%.2f)" % ( math.degrees( math.atan(args.heightMm / ( args.rBottomMm - args.rTopMm ))), printer_max_overhang )
+            print "Raft pitch (%.2f) must be no less than the extrusion width (%.2f)." % ( pitch, printer_extrusion_width )
             exit(1)
+    
+    for pattern in [ raft_base_pattern, raft_iface_pattern ]:
+        if pattern not in raft_patterns:
+            print "Aborted."
+            print "Raft pattern (%s) must be one of: %s." % ( pattern, ", ".join( raft_patterns ) )
+            exit(1)
+    
+    # The object prints at the flow the full raft leaves the extruder set to, whichever layers are printed
+    if raft_iface_cruise_height > 0:
+        object_flow_rate = printer_base_flow_rate * raft_iface_flow_multiplier
+    elif raft_base_cruise_height > 0:
+        object_flow_rate = printer_base_flow_rate * raft_base_flow_multiplier
+    else:
+        object_flow_rate = printer_base_flow_rate
+    
+    # Thicker layers than the configured layer_height need more plastic per mm, in proportion, as
+    # adaptive layers do. --time-budget and --sweep-layer change the layer height.
+    layer_flow_scale = 1.0
+    
+    # Leave out raft layers as if their cruise height were zero. The object sits on whatever is left.
+    if args.raft != 'full':
+        raft_iface_cruise_height = 0
+    if args.raft == 'skirt':
+        raft_base_cruise_height = 0
+    
+    if raft_iface_cruise_height > 0:
+        raft_top = raft_iface_cruise_height
+    else:
+        raft_top = raft_base_cruise_height
+    
+    base_radius = shape['validate']()
+
+# Shapes
+#
+# Every shape is a surface of revolution, described by an entry in the shapes registry:
+#     arguments(parser)   adds the shape's options to its subcommand parser
+#     validate()          aborts if the shape's options are unusable, otherwise returns the radius at the base
+#     radius(h)           returns the radius in mm for an array of heights, as fractions (0.0 - 1.0) of args.heightMm
+#
+# To add a shape, write these three functions and add them to the registry.
+
+def cylinderArguments(parser):
+    parser.add_argument("-r", "--radius", type=float, dest="radius", help="set the radius of a right cylinder in mm", default=25)
+
+def cylinderValidate():
+    if ( args.radius < 5.00 ) or ( args.radius > printer_max_radius ):
+        print "Aborted."
+        print "If specified, radius (%.2f) must be between 5.00 and %.2f." % ( args.radius, printer_max_radius )
+        exit(1)
+    
+    return args.radius
+
+def cylinderRadius(h):
+    return numpy.ones_like( h ) * args.radius
+
+def coneArguments(parser):
+    parser.add_argument(      "--rtop", type=float, dest="rTopMm",  help="set the top radius of a cone in mm", default=10.0)
+    parser.add_argument(      "--rbot", type=float, dest="rBottomMm", help="set the bottom radius of a cone in mm", default=25.0)
+
+def coneValidate():
+    if ( args.rBottomMm < 5.00 ) or ( args.rBottomMm > printer_max_radius ):
+        print "Aborted."
+        print "If specified, rbot (%.2f) must be between 5.00 and %.2f." % ( args.rBottomMm, printer_max_radius )
+        exit(1)
+    
+    if ( args.rTopMm < 5.00 ) or ( args.rTopMm > printer_max_radius ):
+        print "Aborted."
+        print "If specified, rtop (%.2f) must be between 5.00 and %.2f." % ( args.rTopMm, printer_max_radius )
+        exit(1)
+    
+    if ( args.rTopMm >= args.rBottomMm ):
+        print "Aborted."
+        print "If specified, rtop (%.2f) must be less than rbot." % ( args.rTopMm )
+        exit(1)
         
+    if ( args.heightMm / ( args.rBottomMm - args.rTopMm ) ) < math.tan(math.radians(printer_max_overhang)):
+        print "Aborted."
+        print "As given, height, rtop, rbot creates an overhang angle (%.2f) less than the minimum (%.2f)" % ( math.degrees( math.atan(args.heightMm / ( args.rBottomMm - args.rTopMm ))), printer_max_overhang )
+        exit(1)
+    
+    return args.rBottomMm
+
+def coneRadius(h):
+    return args.rBottomMm - ( ( args.rBottomMm - args.rTopMm ) * h )
+
+def globeArguments(parser):
+    parser.add_argument("-r", "--radius", type=float, dest="radius", help="set the radius of a truncated globe in mm", default=25)
+
+def globeValidate():
+    if ( args.radius <= 5.00 ) or ( args.radius > 50.00 ):
+        print "Aborted."
+        print "If specified, radius (%.2f) must be between 5.00 and 50.00." % ( args.radius )
+        exit(1)
+    
+    if ( ( args.heightMm / 2 ) > 0.8 * args.radius ):
         
-    elif args.object_type == 'globe':
-        base_radius = args.radius
+        print "Aborted."
+        print "Globe height(%.2f) is too large relative to the selected radius(%.2f)." % ( args.heightMm, args.radius )
+        print "Extreme overhangs will not print."
+        print "Maximum height for this radius is: (%.2f)." % ( args.radius * 1.6 )
         
-        if ( args.radius <= 5.00 ) or ( args.radius > 50.00 ):
+        exit(1)
+    
+    return args.radius
+
+def globeRadius(h):
+    layerH = ( h * args.heightMm ) - ( args.heightMm / 2 )
+    return numpy.sqrt( numpy.abs( args.radius ** 2 - layerH ** 2 ) )
+
+def profileArguments(parser):
+    parser.add_argument("-f", "--file", dest="fh_profile", required=True, type=argparse.FileType('r'), help="CSV file of height,radius points in mm, from the base upwards")
+
+def profileValidate():
+    global profile_heights, profile_radii
+    
+    # Example profile file (a small vase):
+    #
+    # height,radius
+    # 0,20
+    # 15,28
+    # 30,22
+    # 40,15
+    #
+    # Lines which don't start with two numbers (e.g. a header) are ignored.
+    
+    heights = []
+    radii   = []
+    for row in csv.reader(args.fh_profile):
+        try:
+            h, r = float(row[0]), float(row[1])
+        except ( ValueError, IndexError ):
+            continue
+        heights.append(h)
+        radii.append(r)
+    args.fh_profile.close()
+    
+    if len(heights) < 2:
+        print "Aborted."
+        print "The profile must contain at least two height,radius points."
+        exit(1)
+    
+    if heights[0] != 0.0:
+        print "Aborted."
+        print "The profile must start at height 0.00, not %.2f." % ( heights[0] )
+        exit(1)
+    
+    if heights[-1] < args.heightMm:
+        print "Aborted."
+        print "The profile ends at height %.2f, below the object height (%.2f)." % ( heights[-1], args.heightMm )
+        exit(1)
+    
+    for i in range( 1, len(heights) ):
+        dh = heights[i] - heights[i-1]
+        dr = abs( radii[i] - radii[i-1] )
+        
+        if dh <= 0:
             print "Aborted."
-            print "If specified, radius (%.2f) must be between 5.00 and 50.00." % ( args.radius )
+            print "Profile heights must increase, but %.2f follows %.2f." % ( heights[i], heights[i-1] )
             exit(1)
         
-        if ( ( args.heightMm / 2 ) > 0.8 * args.radius ):
-            
+        if ( dr > 0 ) and ( dh / dr ) < math.tan(math.radians(printer_max_overhang)):
             print "Aborted."
-            print "Globe height(%.2f) is too large relative to the selected radius(%.2f)." % ( args.heightMm, args.radius )
-            print "Extreme overhangs will not print."
-            print "Maximum height for this radius is: (%.2f)." % ( args.radius * 1.6 )
-            
+            print "Between heights %.2f and %.2f the profile creates an overhang angle (%.2f) less than the minimum (%.2f)" % ( heights[i-1], heights[i], math.degrees( math.atan( dh / dr ) ), printer_max_overhang )
             exit(1)
-            
+    
+    for r in radii:
+        if ( r < 5.00 ) or ( r > printer_max_radius ):
+            print "Aborted."
+            print "Every profile radius (%.2f) must be between 5.00 and %.2f." % ( r, printer_max_radius )
+            exit(1)
+    
+    profile_heights = numpy.array( heights )
+    profile_radii   = numpy.array( radii )
+    
+    return radii[0]
+
+def profileRadius(h):
+    return numpy.interp( h * args.heightMm, profile_heights, profile_radii )
+
+shapes = collections.OrderedDict([
+    ( 'cylinder', { 'arguments': cylinderArguments, 'validate': cylinderValidate, 'radius': cylinderRadius } ),
+    ( 'cone',     { 'arguments': coneArguments,     'validate': coneValidate,     'radius': coneRadius } ),
+    ( 'globe',    { 'arguments': globeArguments,    'validate': globeValidate,    'radius': globeRadius } ),
+    ( 'profile',  { 'arguments': profileArguments,  'validate': profileValidate,  'radius': profileRadius } ),
+])
+
 def getGcodeFromFile(filehandle):
     if filehandle is None:
         code=""
@@ -300,67 +776,116 @@ def getGcodeFromFile(filehandle):
     return code
 
 def makeRaft():
-    "Generate a raft"
+    "Generate a raft, or a skirt in its place"
     
+    flow_rate = None
     if raft_base_cruise_height > 0:
-        z = raft_base_cruise_height
-        
-        print "%s S%.2f" % ( gcode_flow_cmd, printer_base_flow_rate * raft_base_flow_multiplier )
-        
-        points = makeRaftPoints( base_radius + raft_margin )
-        
-        p = points[0]
-        print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( p[0],p[1],z,printer_base_move_rate )
-        
-        print "%s" % ( gcode_start_cmd )
-        
-        for p in points[1:]:
-            print "G1 X%.2f Y%.2f Z%.2f F%.1f" % (p[0],p[1],z,printer_base_feed_rate * raft_base_feed_multiplier)
-            
-        print "%s" % ( gcode_stop_cmd )
+        flow_rate = makeRaftLayer( 'raft_base', raft_base_cruise_height, raft_base_pitch, raft_base_pattern, False,
+                                   raft_base_flow_multiplier, raft_base_feed_multiplier )
     
+    # The interface lines run across those of the base
     if raft_iface_cruise_height > 0:
-        z = raft_iface_cruise_height
-        
-        print "%s S%.2f" % ( gcode_flow_cmd, printer_base_flow_rate * raft_iface_flow_multiplier )
-        
-        points = makeRaftPoints( base_radius + raft_margin )
+        flow_rate = makeRaftLayer( 'raft_interface', raft_iface_cruise_height, raft_iface_pitch, raft_iface_pattern, True,
+                                   raft_iface_flow_multiplier, raft_iface_feed_multiplier )
+    
+    if args.raft == 'skirt':
+        flow_rate = makeSkirt()
+    
+    # Without the interface layer, or with other than the configured layer height, the flow left
+    # isn't the object's
+    if flow_rate != object_flow_rate * layer_flow_scale:
+        print "%s S%.2f" % ( gcode_flow_cmd, object_flow_rate * layer_flow_scale )
+
+def makeRaftLayer(section, z, pitch, pattern, across, flow_multiplier, feed_multiplier):
+    """
+    Generate one raft layer. A grid is a second set of lines across the first, in the same layer.
+    Returns the flow it leaves the extruder set to.
+    """
+    
+    indexSection( section, 0, z )
+    
+    flow_rate = printer_base_flow_rate * flow_multiplier
+    print "%s S%.2f" % ( gcode_flow_cmd, flow_rate )
+    
+    feedrate = printer_base_feed_rate * feed_multiplier
+    xs, ys = makeRaftPoints( base_radius + raft_margin, pitch )
+    
+    for swap in ( [ across ] if pattern == 'zigzag' else [ across, not across ] ):
+        if swap:
+            x, y = ys, xs
+        else:
+            x, y = xs, ys
         
-        p = points[0]
-        print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( p[1],p[0],z,printer_base_move_rate )
+        print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( x[0], y[0], z, printer_base_move_rate )
         
         print "%s" % ( gcode_start_cmd )
         
-        for p in points[1:]:
-            print "G1 X%.2f Y%.2f Z%.2f F%.1f" % (p[1],p[0],z,printer_base_feed_rate * raft_iface_feed_multiplier)
-            
+        sys.stdout.write( "".join( [ "G1 X%.2f Y%.2f Z%.2f F%.1f\n" % ( p[0], p[1], z, feedrate ) for p in zip( x[1:].tolist(), y[1:].tolist() ) ] ) )
+        
         print "%s" % ( gcode_stop_cmd )
-
-def makeRaftPoints(radius):
-    "Returns an array of points defining a circular raft layer"
     
-    points = [( -radius, 0 )]
+    if args.verbose > 0:
+        length = getRaftLength( pitch, pattern )
+        print >> sys.stderr, "Raft %s: %s at %.2f mm pitch, %.0f mm of extrusion, %.1f min" % ( section[5:], pattern, pitch, length, length / feedrate )
     
-    x = -radius
-    y = 0
+    return flow_rate
+
+def getRaftLength(pitch, pattern):
+    "Returns the length in mm of the lines of a raft layer"
+    xs, ys = makeRaftPoints( base_radius + raft_margin, pitch )
+    return ( 1 if pattern == 'zigzag' else 2 ) * numpy.hypot( numpy.diff( xs ), numpy.diff( ys ) ).sum()
+
+def makeRaftPoints(radius, pitch):
+    "Returns arrays of the X and Y of points zigzagging across a circular raft layer"
     
-    # FIXME - should be able to set the coarseness of the raft
+    # Space the lines evenly across the circle, no further apart than pitch
+    incr = ( 2 * radius ) / ( ( 2 * radius ) // pitch + 1 )
     
-    incr = ( 2 * radius ) / ( ( 2 * radius ) // ( 4 * printer_extrusion_width ) + 1 )
+    # Step across from the left edge until just past the right, accumulating x as a running sum
+    # just as the loop this replaced did, so that the output is unchanged
+    x = numpy.cumsum( [ -radius ] + [ incr ] * ( int( ( 2 * radius ) / incr ) + 3 ) )
+    x = x[1:numpy.count_nonzero( x <= radius ) + 1]
+    y = numpy.sqrt( numpy.abs( radius**2 - x**2 ) )
     
-    direction=1
+    # Each step goes along the line, then across to the next, changing direction every time
+    direction = numpy.where( numpy.arange( len(x) ) % 2 == 0, 1, -1 )
     
-    while x <= radius:
-        
-        x = x + incr
-        y = math.sqrt( abs (radius**2 - x**2 ) )
-        
-        points.append( ( x,  y * direction ) )
-        points.append( ( x, -y * direction ) )
-        
-        direction = direction * -1
+    xs = numpy.concatenate( ( [ -radius ], numpy.repeat( x, 2 ) ) )
+    ys = numpy.concatenate( ( [ 0.0 ], numpy.column_stack( ( y * direction, -y * direction ) ).ravel() ) )
+    
+    return xs, ys
 
-    return points
+def makeSkirt():
+    """
+    Generate a skirt, loops on the bed around the object which prime the extruder in place of a raft.
+    Returns the flow it leaves the extruder set to.
+    """
+    
+    # The skirt is one layer high, so its flow is scaled with the layer height as the object's is
+    z = printer_layer_height
+    indexSection( 'skirt', 0, z )
+    
+    flow_rate = printer_base_flow_rate * layer_flow_scale
+    print "%s S%.2f" % ( gcode_flow_cmd, flow_rate )
+    
+    # From the outside in, each loop leading straight on to the next
+    points = []
+    for loop in range( skirt_loops ):
+        radius = base_radius + raft_margin - loop * printer_extrusion_width
+        segs = max( 20, int( 2 * math.pi * radius / skirt_segment ) )
+        theta = numpy.linspace( 0, 2 * math.pi, segs + 1 )
+        points.extend( zip( ( radius * numpy.cos( theta ) ).tolist(), ( radius * numpy.sin( theta ) ).tolist() ) )
+    
+    p = points[0]
+    print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( p[0], p[1], z, printer_base_move_rate )
+    
+    print "%s" % ( gcode_start_cmd )
+    
+    sys.stdout.write( "".join( [ "G1 X%.2f Y%.2f Z%.2f F%.1f\n" % ( p[0], p[1], z, printer_base_feed_rate ) for p in points[1:] ] ) )
+    
+    print "%s" % ( gcode_stop_cmd )
+    
+    return flow_rate
 
 def makeBase():
     if args.bottomLayers > 0:
@@ -371,7 +896,8 @@ def makeBase():
 def makeBaseLayer(layer):
     "Generate a spiral base layer"
 
-    z = raft_iface_cruise_height + printer_layer_height * ( layer )
+    z = raft_top + printer_layer_height * ( layer )
+    indexSection( 'base', layer, z )
     
     points = makeSpiralPoints( base_radius + printer_extrusion_width)
     
@@ -411,37 +937,864 @@ def makeSpiralPoints(radius):
     return points
 
 def getImagePixels():
-    global im, pixels, segments
-    im = Image.open(args.fh_image).convert("L")
-    pixels = im.load()
-    segments = max(20,im.size[0])
+    global heightmap, heightmapPath, segments
+    heightmap, heightmapPath = getHeightMap()
+    segments = max(20,heightmap.shape[1])
+
+def getHeightMap():
+    """
+    Returns the preprocessed image as an array of luminance values, and the path of its cached copy
+    (or None). The cached copy is memory mapped, so processes sharing a cache directory share one
+    copy of each height map, and only the first of them to need it decodes the image.
+    """
+    
+    data = args.fh_image.read()
+    args.fh_image.close()
+    
+    steps = getPreprocessSteps()
+    
+    if args.cache == None:
+        im = Image.open( StringIO.StringIO( data ) ).convert("L")
+        return preprocessImage( numpy.asarray( im, dtype=float ), steps ), None
+    
+    key = hashlib.sha1( data )
+    key.update( repr( ( heightmap_version, steps ) ) )
+    path = os.path.join( args.cache, key.hexdigest() + ".npy" )
+    
+    lock = lockHeightMap( path )
+    try:
+        if os.path.exists( path ):
+            if args.verbose > 0:
+                print >> sys.stderr, "Height map: " + path + " (cached)"
+            return numpy.load( path, mmap_mode='r' ), path
+        
+        im = Image.open( StringIO.StringIO( data ) ).convert("L")
+        values = preprocessImage( numpy.asarray( im, dtype=float ), steps )
+        
+        # Write under a temporary name and rename, so that a reader never sees half a file
+        temp = "%s.%d.tmp" % ( path, os.getpid() )
+        numpy.save( open( temp, 'wb' ), values )
+        try:
+            os.rename( temp, path )
+        except OSError:
+            os.remove( temp )
+        if args.verbose > 0:
+            print >> sys.stderr, "Height map: " + path
+    finally:
+        if lock != None:
+            os.close( lock )
+            os.remove( path + ".lock" )
+    
+    return numpy.load( path, mmap_mode='r' ), path
 
-def getPixelValue( layer, segment ):
-    # Luminance values from 0.00 (black, slow feed rate) to 1.00 (white, normal feed rate) are returned
-    x = segment
-    y = ( im.size[1] - int( float( im.size[1] * layer ) / layerCount ) ) - 1
-    return ( pixels[x,y] / 256.0 )
+def lockHeightMap(path):
+    "Claims the making of a cached height map, or waits for the process which already has. Returns the lock to release, if any."
+    
+    waited = 0.0
+    while not os.path.exists( path ):
+        try:
+            return os.open( path + ".lock", os.O_CREAT | os.O_EXCL | os.O_WRONLY )
+        except OSError:
+            # Give up on a process which seems to have died, and make the height map here instead
+            if waited >= heightmap_wait:
+                return None
+            time.sleep( 0.05 )
+            waited = waited + 0.05
+    return None
 
-def makeShape():
-    print "(%s start)" % ( args.object_type.capitalize() )
+def getPreprocessSteps():
+    "Returns the requested preprocessing as a list of (operation, parameter) pairs, in the order they are applied"
     
-    pos = getShapeXYZ( 1, 0 )
-    print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], printer_base_move_rate )
+    steps = []
+    if args.levels != None:
+        steps.append( ( 'levels', args.levels ) )
+    if args.gamma != 1.0:
+        steps.append( ( 'gamma', args.gamma ) )
+    if args.blur > 0:
+        steps.append( ( 'blur', args.blur ) )
+    if args.sharpen > 0:
+        steps.append( ( 'sharpen', args.sharpen ) )
+    if args.dither > 0:
+        steps.append( ( 'dither', args.dither ) )
+    return steps
+
+def preprocessImage(pixels, steps):
+    "Applies the preprocessing steps to an array of 0 - 255 pixels, returning luminance values from 0.00 to 1.00"
+    
+    if not steps:
+        # Keep exactly the values the embossing has always used
+        return ( pixels / 256.0 ).astype( numpy.float32 )
+    
+    v = pixels / 255.0
+    for op, param in steps:
+        if op == 'levels':
+            lo, hi = param
+            v = numpy.clip( ( v - lo / 255.0 ) / ( ( hi - lo ) / 255.0 ), 0.0, 1.0 )
+        elif op == 'gamma':
+            v = v ** ( 1.0 / param )
+        elif op == 'blur':
+            v = blurImage( v, param )
+        elif op == 'sharpen':
+            v = numpy.clip( v + param * ( v - blurImage( v, 1.0 ) ), 0.0, 1.0 )
+        elif op == 'dither':
+            # Ordered (Bayer) dithering, tiled across the whole image
+            bayer = numpy.array( [ [ 0, 8, 2, 10 ], [ 12, 4, 14, 6 ], [ 3, 11, 1, 9 ], [ 15, 7, 13, 5 ] ] ) / 16.0 + 1 / 32.0
+            threshold = numpy.tile( bayer, ( v.shape[0] // 4 + 1, v.shape[1] // 4 + 1 ) )[ :v.shape[0], :v.shape[1] ]
+            v = numpy.floor( v * ( param - 1 ) + threshold ) / ( param - 1 )
+            v = numpy.clip( v, 0.0, 1.0 )
+    
+    return ( v * 255.0 / 256.0 ).astype( numpy.float32 )
+
+def blurImage(v, radius):
+    "Approximates a gaussian blur with three box blurs. The image wraps around the object, so rows wrap too."
+    
+    width = int( round( radius ) )
+    if width < 1:
+        return v
+    
+    for i in range( 3 ):
+        # Horizontally: wrap around
+        padded = numpy.concatenate( ( v[:, -width-1:], v, v[:, :width] ), axis=1 )
+        total  = numpy.cumsum( padded, axis=1 )
+        v = ( total[:, 2*width+1:] - total[:, :-2*width-1] ) / ( 2 * width + 1 )
+        
+        # Vertically: repeat the top and bottom rows
+        padded = numpy.concatenate( ( numpy.repeat( v[:1], width + 1, axis=0 ), v, numpy.repeat( v[-1:], width, axis=0 ) ), axis=0 )
+        total  = numpy.cumsum( padded, axis=0 )
+        v = ( total[2*width+1:] - total[:-2*width-1] ) / ( 2 * width + 1 )
+    
+    return v
+
+def getImageRows(position):
+    "Returns the image row for each of an array of positions, counted in rows from the bottom of the image"
+    height = heightmap.shape[0]
+    return numpy.clip( ( height - position.astype(int) ) - 1, 0, height - 1 ).tolist()
+
+def getSegmentCount(radius):
+    "Returns the number of segments around a layer of the given radius"
+    if args.chordMm == None:
+        return segments
+    return max( 20, int( round( 2 * math.pi * radius / args.chordMm ) ) )
+
+def getSegmentDirections(segs):
+    "Returns the unit X and Y of every segment around a layer, caching them for each number of segments"
+    if segs not in segmentDirections:
+        angles = ( 2*math.pi/segs ) * numpy.arange( segs )
+        segmentDirections[segs] = ( -numpy.sin( angles ), numpy.cos( angles ) )
+    return segmentDirections[segs]
+
+segmentDirections = {}
+
+def getRowValues(row, segs):
+    "Returns the luminance of an image row, resampled to segs equal segments around the layer"
+    
+    values = numpy.asarray( heightmap[row], dtype=float )
+    width  = len(values)
+    if segs == width:
+        return values
+    
+    # Average the row over each segment, treating each pixel as a constant run
+    edges = numpy.arange( segs + 1 ) * float( width ) / segs
+    whole = numpy.minimum( edges.astype(int), width - 1 )
+    total = numpy.concatenate( ( [ 0.0 ], numpy.cumsum( values ) ) )
+    area  = total[whole] + ( edges - whole ) * values[whole]
+    return numpy.diff( area ) / numpy.diff( edges )
+
+def getLayerValues(layer):
+    # Luminance values from 0.00 (black, slow feed rate) to 1.00 (white, normal feed rate) are returned,
+    # for segments 1 onwards
+    return getRowValues( layerRow[layer], layerSegments[layer] )[1:]
+
+def getLayerXYZ(layer):
+    "Returns lists of the X, Y and Z of segments 1 onwards of a layer"
+    
+    segs = layerSegments[layer]
+    dx, dy = getSegmentDirections( segs )
+    r = layerRadius[layer]
+    
+    if args.continuous:
+        z = layerZ[layer] + ( layerRise[layer] * ( numpy.arange( 1, segs ) / float(segs) ) )
+    else:
+        z = numpy.repeat( layerZ[layer], segs - 1 )
+    
+    return ( dx[1:] * r ).tolist(), ( dy[1:] * r ).tolist(), z.tolist()
+
+def makeAdaptiveHeights():
+    "Returns the height in mm above the base of every layer, from 0 up to args.heightMm"
+    
+    # Slope: the staircase of layers on a sloping wall is worst where the wall is furthest from
+    # vertical. Pick the cusp size which gives exactly the configured layer height at the
+    # steepest printable overhang; more vertical walls can then take thicker layers.
+    grid   = numpy.linspace( 0.0, args.heightMm, 1001 )
+    slope  = numpy.abs( numpy.gradient( shape['radius']( grid / args.heightMm ), grid ) )
+    limit  = 1 / math.tan( math.radians( printer_max_overhang ) )
+    cusp   = printer_layer_height * limit / math.sqrt( 1 + limit ** 2 )
+    
+    # Detail: a layer samples a single image row, so it mustn't skip over rows that differ
+    # (on average across the row) by more than adaptive_detail from the one it samples.
+    rows   = numpy.asarray( heightmap, dtype=float )
+    height = heightmap.shape[0]
+    rowMm  = float( args.heightMm ) / height
+    
+    heights = [ 0.0 ]
+    h = 0.0
+    while h < args.heightMm:
+        s = max( numpy.interp( h, grid, slope ), numpy.interp( min( h + args.maxLayerMm, args.heightMm ), grid, slope ) )
+        t = args.maxLayerMm if s == 0 else cusp * math.sqrt( 1 + s ** 2 ) / s
+        
+        k0 = min( int( h / rowMm ), height - 1 )
+        k1 = min( int( ( h + args.maxLayerMm ) / rowMm ), height - 1 )
+        span = rows[ height - 1 - k1 : height - k0 ][::-1]
+        lost = numpy.maximum.accumulate( numpy.abs( span - span[0] ).mean( axis=1 ) )
+        t = min( t, ( k0 + numpy.count_nonzero( lost <= adaptive_detail ) ) * rowMm - h )
+        
+        t = min( max( t, args.minLayerMm ), args.maxLayerMm, args.heightMm - h )
+        h = h + t
+        heights.append( h )
+    
+    return numpy.array( heights )
+
+def estimateShapeTime(heights, factors=None):
+    """
+    Returns the estimated time in minutes to print the shape layers at the given heights with
+    args.embossFactor or, if a list of emboss factors is given, an array of the time with each
+    """
+    
+    fractions = heights[1:-1] / args.heightMm
+    radii = shape['radius']( fractions ).tolist()
+    rows  = getImageRows( heightmap.shape[0] * fractions )
+    
+    # Each move takes its length over its feed rate, 1 / ( 1 - ( 1 - value ) * ( 1 - factor ) ) of the
+    # normal feed rate. Only pixel values and emboss factors vary, so sum over the distinct values.
+    slowdown = 1 - numpy.atleast_1d( args.embossFactor if factors is None else factors )
+    total = numpy.zeros( len(slowdown) )
+    for r, row in zip( radii, rows ):
+        segs   = getSegmentCount( r )
+        values = getRowValues( row, segs )[1:]
+        feeds  = printer_base_feed_rate * ( 1 - numpy.outer( 1 - values, slowdown ) )
+        total  = total + 2 * r * math.sin( math.pi / segs ) * ( 1 / feeds ).sum( axis=0 )
+    
+    return total[0] if factors is None else total
+
+def estimateFixedTime():
+    "Returns the estimated time in minutes to print the raft (or skirt) and the base, which don't depend on the layer height or emboss factor"
+    
+    total = 0.0
+    for height, pitch, pattern, feed_multiplier in [
+            ( raft_base_cruise_height,  raft_base_pitch,  raft_base_pattern,  raft_base_feed_multiplier ),
+            ( raft_iface_cruise_height, raft_iface_pitch, raft_iface_pattern, raft_iface_feed_multiplier ) ]:
+        if height > 0:
+            total = total + getRaftLength( pitch, pattern ) / ( printer_base_feed_rate * feed_multiplier )
+    
+    if args.raft == 'skirt':
+        total = total + sum( [ 2 * math.pi * ( base_radius + raft_margin - loop * printer_extrusion_width ) for loop in range( skirt_loops ) ] ) / printer_base_feed_rate
+    
+    if args.bottomLayers > 0:
+        points = numpy.array( makeSpiralPoints( base_radius + printer_extrusion_width ) )
+        total = total + args.bottomLayers * numpy.hypot( *numpy.diff( points, axis=0 ).T ).sum() / printer_base_feed_rate
+    
+    return total
+
+def fitTimeBudget():
+    """
+    Chooses the settings for --time-budget. The embossing is what the object is for, so the emboss
+    factor stays as given if at all possible, with the thinnest layers that fit; only if even the
+    thickest layers don't fit is the emboss factor raised, a step at a time.
+    """
+    global printer_layer_height, layer_flow_scale
+    
+    budget  = args.timeBudget * 60
+    fixed   = estimateFixedTime()
+    layers  = numpy.append( numpy.arange( printer_layer_height, printer_extrusion_width - 1e-6, budget_layer_step ), printer_extrusion_width )
+    factors = numpy.append( numpy.arange( args.embossFactor, 1.0 - 1e-6, budget_emboss_step ), 1.0 )
+    
+    # The time of every combination, one row per emboss factor and one column per layer height
+    times = fixed + numpy.column_stack( [ estimateShapeTime( numpy.arange( int( args.heightMm / lh ) + 1 ) * lh, factors ) for lh in layers ] )
+    
+    fits = numpy.argwhere( times <= budget )
+    if len(fits) == 0:
+        print "Aborted."
+        print "Even with %.2f mm layers and no embossing, the print is estimated to take %.1f hours, over the time budget (%.2f hours)." % ( layers[-1], times[-1,-1] / 60, args.timeBudget )
+        exit(1)
+    
+    # argwhere lists them by emboss factor, then layer height
+    f, l = fits[0]
+    layer_flow_scale = round( layers[l], 2 ) / printer_layer_height
+    printer_layer_height = round( layers[l], 2 )
+    args.embossFactor = round( factors[f], 2 )
+    
+    print >> sys.stderr, "Time budget %.2f hours: %.2f mm layers, embossFactor %.2f, estimated %.1f min (%.1f min of raft and base, %.1f min of shape)." % (
+        args.timeBudget, printer_layer_height, args.embossFactor, times[f,l], fixed, times[f,l] - fixed )
+
+def reportAdaptiveHeights(heights):
+    uniform = numpy.arange( int( args.heightMm / printer_layer_height ) + 1 ) * printer_layer_height
+    rises   = numpy.diff( heights )[:-1]
+    
+    adaptive_time = estimateShapeTime( heights )
+    uniform_time  = estimateShapeTime( uniform )
+    
+    print >> sys.stderr, "Adaptive layers: %d layers of %.2f - %.2f mm instead of %d of %.2f mm." % ( len(heights) - 2, rises.min(), rises.max(), len(uniform) - 2, printer_layer_height )
+    print >> sys.stderr, "Estimated shape print time: %.1f min instead of %.1f min (%.1f min saved)." % ( adaptive_time, uniform_time, uniform_time - adaptive_time )
+
+def cancel(signum=None, frame=None):
+    "Ask makeShape() to stop at the end of the current layer. A second signal aborts immediately."
+    global cancelled
+    
+    if cancelled and signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    cancelled = True
+
+def reportProgress(event, layer, lines):
+    "Sends a progress event to progressCallback and, if requested, to the progress file descriptor"
+    global progress_last
+    
+    now = time.time()
+    if event == 'layer' and ( now - progress_last ) < progress_interval:
+        return
+    progress_last = now
+    
+    layers  = int(layerCount) - 1
+    done    = layer - ( args.startLayer or 1 ) + 1
+    elapsed = now - progress_start
+    
+    report = {
+        'event':   event,
+        'layer':   layer,
+        'layers':  layers,
+        'lines':   lines,
+        'elapsed': round( elapsed, 3 ),
+        'lines_per_sec': round( lines / elapsed, 1 ) if elapsed > 0 else 0.0,
+        'eta':     round( elapsed / done * ( layers - layer ), 1 ) if done > 0 else None,
+    }
+    
+    if progressCallback is not None:
+        progressCallback(report)
+    
+    if args.progress == 'json':
+        print >> progress_fh, json.dumps( report, sort_keys=True )
+        progress_fh.flush()
+    elif args.progress == 'text':
+        eta = report['eta'] or 0
+        progress_fh.write( "\rLayer %d/%d  %.0f lines/sec  ETA %d:%02d " % ( layer, layers, report['lines_per_sec'], eta // 60, eta % 60 ) )
+        if event != 'layer':
+            progress_fh.write( "(%s)\n" % ( event ) )
+        progress_fh.flush()
+
+def sweeping():
+    return ( args.sweepEmboss != None ) or ( args.sweepLayer != None )
+
+def getSweepVariants():
+    "Returns every (embossFactor, layer height) pair in the sweep"
+    return [ ( e, lh ) for lh in ( args.sweepLayer or [ printer_layer_height ] ) for e in ( args.sweepEmboss or [ args.embossFactor ] ) ]
+
+def runSweep():
+    "Generates every variant of the sweep, sharing the work that doesn't depend on the emboss factor"
+    global printer_layer_height, layer_flow_scale
+    
+    layer_height = printer_layer_height
+    for lh in ( args.sweepLayer or [ printer_layer_height ] ):
+        printer_layer_height = lh
+        layer_flow_scale = lh / layer_height
+        makeLayerTables()
+        
+        outputs = []
+        for e in ( args.sweepEmboss or [ args.embossFactor ] ):
+            name = args.sweepOutput.format( emboss=e, layer=lh )
+            fh = open( name, 'w' if args.format == 'text' else 'wb' )
+            outputs.append( { 'embossFactor': e, 'fh': openOutput( fh ), 'file': fh } )
+            if args.verbose > 0:
+                print >> sys.stderr, "Sweep: " + name
+        
+        generate( outputs )
+        
+        for output in outputs:
+            output['file'].close()
+        
+        if cancelled:
+            break
+
+def indexSection(section, layer, z):
+    "Records where a section or layer starts in the output, for the --index sidecar file"
+    if args.index:
+        layerIndex.append( { 'section': section, 'layer': layer, 'offset': sys.stdout.tell(), 'z': round( z, 3 ) } )
+
+def writeIndex():
+    "Writes the index of sections and layers as JSON, one entry per line, alongside the output"
+    
+    index = open( args.fh_output.name + ".idx", 'w' )
+    print >> index, '{"output": %s, "bytes": %d, "sections": [' % ( json.dumps( args.fh_output.name ), sys.stdout.tell() )
+    print >> index, ",\n".join( [ json.dumps( entry, sort_keys=True ) for entry in layerIndex ] )
+    print >> index, ']}'
+    index.close()
+
+def writeAll(outputs, line):
+    for output in outputs:
+        output['fh'].write( line + "\n" )
+
+def xorBytes(text):
+    "Returns the XOR of all the bytes of text"
+    return int( numpy.bitwise_xor.reduce( numpy.frombuffer( text, numpy.uint8 ) ) ) if text else 0
+
+class ChecksumWriter(object):
+    """
+    Wraps an output file, numbering every command line and appending its checksum as it is
+    written, so that a host can send the output over a serial line without a second pass:
+    
+        G1 X1.00 Y2.00 Z0.30 F1000.0   becomes   N57 G1 X1.00 Y2.00 Z0.30 F1000.0*83
+    
+    The checksum is the XOR of every byte before the '*'. Comments, firmware header lines (^)
+    and blank lines are passed through unnumbered. If the output is seekable, the ^Checksum:
+    header is filled in at finish() with the CRC-32 of everything after it, as 8 hex digits.
+    """
+    
+    skipped = ( "", "(", "^", ";" )
+    batch = 65536   # Bytes of complete lines to collect before numbering them
+    
+    # Line numbers are built from their last three digits, looked up here, and the rest, which
+    # changes only every thousand lines. The checksums of the pieces are looked up likewise.
+    lows   = [ "%d " % ( n ) for n in range(1000) ]
+    lows0  = [ "%03d " % ( n ) for n in range(1000) ]
+    lowsXor  = numpy.array( [ xorBytes( t ) for t in lows ],  numpy.uint8 )
+    lows0Xor = numpy.array( [ xorBytes( t ) for t in lows0 ], numpy.uint8 )
+    suffixes = numpy.array( [ "*%d\n" % ( c ) for c in range(256) ], object )
+    
+    def __init__(self, fh):
+        self.fh = fh
+        self.number = 1
+        self.pending = ""
+        self.queue = []
+        self.queued = 0
+        self.header = None
+        self.crc = None
+    
+    def __getattr__(self, name):
+        return getattr( self.fh, name )
+    
+    def write(self, data):
+        # Only whole lines can be numbered, so hold back any partial line, e.g. from print
+        if self.pending:
+            data = self.pending + data
+            self.pending = ""
+        if not data.endswith( "\n" ):
+            end = data.rfind( "\n" ) + 1
+            self.pending = data[end:]
+            data = data[:end]
+        
+        # Numbering has a fixed cost per call, so collect small writes into larger batches
+        if data:
+            self.queue.append( data )
+            self.queued = self.queued + len(data)
+            if self.queued >= self.batch:
+                self.drain()
+    
+    def drain(self):
+        if not self.queue:
+            return
+        data = "".join( self.queue )
+        self.queue = []
+        self.queued = 0
+        
+        lines = data.split( "\n" )
+        lines.pop()
+        
+        if ( "(" in data ) or ( "^" in data ) or ( ";" in data ) or ( "" in lines ):
+            self.writeMixed( lines )
+        else:
+            self.emit( self.numberLines( data, lines ) )
+    
+    def writeMixed(self, lines):
+        "Numbers each run of commands, passing the lines between them through unchanged"
+        start = 0
+        for i, line in enumerate(lines):
+            if line[:1] in self.skipped:
+                if i > start:
+                    self.emit( self.numberLines( "\n".join( lines[start:i] ) + "\n", lines[start:i] ) )
+                if line.startswith( checksum_header ) and ( self.header == None ):
+                    self.writeHeader( line )
+                else:
+                    self.emit( line + "\n" )
+                start = i + 1
+        if start < len(lines):
+            self.emit( self.numberLines( "\n".join( lines[start:] ) + "\n", lines[start:] ) )
+    
+    def numberLines(self, data, lines):
+        "Returns the lines of data, which are all commands, numbered and checksummed"
+        count = len(lines)
+        
+        # XOR the bytes of each line, cancelling its newline
+        buf = numpy.frombuffer( data, numpy.uint8 )
+        starts = numpy.empty( count, numpy.intp )
+        starts[0] = 0
+        starts[1:] = numpy.flatnonzero( buf[:-1] == 10 ) + 1
+        checksums = numpy.bitwise_xor.reduceat( buf, starts ) ^ ord("\n")
+        
+        # Interleave the pieces of every line, "N" and the high digits, the low digits and a
+        # space, the line itself, and its checksum, and join them just once
+        out = [ None ] * ( 4 * count )
+        i = 0
+        while i < count:
+            high, low = divmod( self.number, 1000 )
+            stop = min( count, i + 1000 - low )
+            if high > 0:
+                prefix = "N%d" % ( high )
+                out[4*i+1:4*stop:4] = self.lows0[low:low + stop - i]
+                checksums[i:stop] ^= self.lows0Xor[low:low + stop - i] ^ xorBytes( prefix )
+            else:
+                prefix = "N"
+                out[4*i+1:4*stop:4] = self.lows[low:low + stop - i]
+                checksums[i:stop] ^= self.lowsXor[low:low + stop - i] ^ xorBytes( prefix )
+            out[4*i:4*stop:4] = [ prefix ] * ( stop - i )
+            self.number = self.number + stop - i
+            i = stop
+        out[2::4] = lines
+        out[3::4] = self.suffixes.take( checksums ).tolist()
+        return "".join( out )
+    
+    def writeHeader(self, line):
+        "Writes the ^Checksum: header, reserving room for the whole-file checksum if the output can be rewritten later"
+        try:
+            self.header = self.fh.tell() + len( checksum_header )
+        except IOError:
+            self.emit( line + "\n" )
+            return
+        self.emit( checksum_header + "0" * 8 + "\n" )
+        self.crc = 0
+    
+    def emit(self, text):
+        self.fh.write( text )
+        if self.crc != None:
+            self.crc = zlib.crc32( text, self.crc )
+    
+    def tell(self):
+        self.drain()
+        return self.fh.tell()
+    
+    def flush(self):
+        self.drain()
+        self.fh.flush()
+    
+    def finish(self):
+        "Writes any unterminated last line, and fills in the whole-file checksum"
+        if self.pending:
+            self.write( "\n" )
+        self.drain()
+        if self.crc != None:
+            self.fh.seek( self.header )
+            self.fh.write( "%08x" % ( self.crc & 0xffffffff ) )
+            self.fh.seek( 0, os.SEEK_END )
+            self.crc = None
+
+def openOutput(fh):
+    "Returns an output file wrapped to write the chosen --format, with --checksum and --write-buffers if requested"
+    
+    if args.writeBuffers > 0:
+        fh = ThreadedWriter( fh, args.writeBuffers )
+    
+    if args.format == 'text':
+        return ChecksumWriter( fh ) if args.checksum else fh
+    
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode( fh.fileno(), os.O_BINARY )
+    
+    if args.format == 'gzip':
+        return GzipWriter( "", 'wb', gzip_level, fh )
+    return BinaryWriter( fh )
+
+class ThreadedWriter(object):
+    """
+    Wraps an output file, collecting what is written into buffers of writer_buffer bytes and
+    handing each to a background thread to write, so that generation carries on meanwhile. Up
+    to depth full buffers can wait for the thread; only once they have does generation stall.
+    flush() waits for the thread to write everything so far and, with -v, reports how long
+    generation stalled for.
+    """
+    
+    def __init__(self, fh, depth):
+        self.fh = fh
+        self.depth = depth
+        self.buffer = []
+        self.buffered = 0
+        self.thread = None
+        self.error = None
+        
+        # Keep track of the position, so that tell() needn't wait for the thread
+        try:
+            self.position = fh.tell()
+        except IOError:
+            self.position = None
+        
+        self.written = 0
+        self.buffers = 0
+        self.stalled = 0.0
+        self.busy = 0.0
+    
+    def __getattr__(self, name):
+        return getattr( self.fh, name )
+    
+    def write(self, data):
+        self.buffer.append( data )
+        self.buffered = self.buffered + len(data)
+        if self.buffered >= writer_buffer:
+            self.handOff()
+    
+    def handOff(self):
+        "Queues the buffer for the thread, waiting for room in the queue if need be"
+        if self.error != None:
+            raise self.error
+        
+        if self.thread == None:
+            self.queue = Queue.Queue( self.depth )
+            self.thread = threading.Thread( target=self.run )
+            self.thread.daemon = True
+            self.thread.start()
+        
+        data = "".join( self.buffer )
+        self.buffer = []
+        self.buffered = 0
+        
+        start = time.time()
+        self.queue.put( data )
+        self.stalled = self.stalled + time.time() - start
+        
+        self.written = self.written + len(data)
+        self.buffers = self.buffers + 1
+    
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data == None:
+                return
+            if self.error != None:
+                continue    # Keep emptying the queue, so that handOff() can't wait forever
+            start = time.time()
+            try:
+                self.fh.write( data )
+            except IOError, e:
+                self.error = e
+            self.busy = self.busy + time.time() - start
+    
+    def tell(self):
+        if self.position == None:
+            return self.fh.tell()
+        return self.position + self.written + self.buffered
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.flush()
+        self.fh.seek( offset, whence )
+        self.position = self.fh.tell()
+        self.written = 0
+    
+    def flush(self):
+        "Waits until everything written so far is in the file, stopping the thread until there's more"
+        if self.thread != None:
+            self.handOff()
+            start = time.time()
+            self.queue.put( None )
+            self.thread.join()
+            self.thread = None
+            if args.verbose > 0:
+                print >> sys.stderr, "Background writer (%s): %.1f MB in %d buffer(s), generation stalled %.2fs waiting for room in the queue and %.2fs for the last writes, writing took %.2fs." % (
+                    self.fh.name, self.written / 1e6, self.buffers, self.stalled, time.time() - start, self.busy )
+            self.position = self.tell() if self.position != None else None
+            self.written = self.buffers = 0
+            self.stalled = self.busy = 0.0
+        elif self.buffer:
+            self.fh.write( "".join( self.buffer ) )
+            self.written = self.written + self.buffered
+            self.buffer = []
+            self.buffered = 0
+        
+        if self.error != None:
+            raise self.error
+        self.fh.flush()
+
+class GzipWriter(gzip.GzipFile):
+    "Compresses the output in gzip format as it is written"
+    
+    def flush(self):
+        # There's nothing left to flush once finish() has written the trailer
+        if self.fileobj != None:
+            gzip.GzipFile.flush( self )
+    
+    def finish(self):
+        "Writes the gzip trailer, leaving the file itself open"
+        fh = self.fileobj
+        self.close()
+        fh.flush()
+
+class BinaryWriter(object):
+    """
+    Wraps an output file, writing the Gcode as compact binary records instead of text. After
+    binary_magic, each record starts with an opcode:
+    
+        'M' <x> <y> <z> <f>     G1 X<x/100> Y<y/100> Z<z/100> F<f/10>, as four little-endian int32
+        'T' <length> <text>     any other line, with its length as a little-endian uint16
+        'C' <length> <text>     text which the next record carries on, for a line too long for one
+                                record, or the end of the output if it has no final newline
+    
+    A value which rounds to -0.00 is stored as negative_zero, so that decode.py can turn the
+    records back into exactly the text they replace. A move takes 17 bytes rather than about 35.
+    """
+    
+    move = numpy.dtype( [ ( 'op', 'u1' ), ( 'x', '<i4' ), ( 'y', '<i4' ), ( 'z', '<i4' ), ( 'f', '<i4' ) ] )
+    negative_zero = -2**31
+    text_limit = 0xffff
+    
+    # Only moves written just as the decoder will write them again can be encoded
+    number = r"(-?(?:0|[1-9][0-9]*)\.[0-9]{%d})"
+    move_line = re.compile( "G1 X%s Y%s Z%s F%s$" % ( number % 2, number % 2, number % 2, number % 1 ) )
+    
+    def __init__(self, fh):
+        self.fh = fh
+        self.pending = ""
+        self.fh.write( binary_magic )
+    
+    def __getattr__(self, name):
+        return getattr( self.fh, name )
+    
+    def write(self, data):
+        # Lines are encoded whole, so hold back any partial line, e.g. from print
+        data = self.pending + data
+        end = data.rfind( "\n" ) + 1
+        self.pending = data[end:]
+        if end == 0:
+            return
+        
+        lines = data[:end - 1].split( "\n" )
+        matches = [ self.move_line.match( line ) for line in lines ]
+        
+        # Read the moves' values as fixed point straight from their digits, all in one go
+        values = list( itertools.chain.from_iterable( [ m.groups() for m in matches if m != None ] ) )
+        fixed = numpy.fromstring( " ".join( values ).replace( ".", "" ), dtype=numpy.int64, sep=" " ).reshape( -1, 4 )
+        for i in numpy.flatnonzero( fixed.ravel() == 0 ):
+            if values[i][0] == "-":
+                fixed.flat[i] = self.negative_zero
+        
+        moves = numpy.empty( len(fixed), self.move )
+        moves['op'] = ord("M")
+        for i, field in enumerate( [ 'x', 'y', 'z', 'f' ] ):
+            moves[field] = fixed[:,i]
+        moves = moves.tostring()
+        
+        records = []
+        pos = 0
+        size = self.move.itemsize
+        for line, m in zip( lines, matches ):
+            if m != None:
+                records.append( moves[pos:pos + size] )
+                pos = pos + size
+            else:
+                records.append( self.encodeText( line, "T" ) )
+        self.fh.write( "".join( records ) )
+    
+    def encodeText(self, text, op):
+        "Returns the records for some text, carrying it on over 'C' records if it is too long for one"
+        chunks = [ text[i:i + self.text_limit] for i in range( 0, len(text), self.text_limit ) ] or [ "" ]
+        ops = [ "C" ] * ( len(chunks) - 1 ) + [ op ]
+        return "".join( [ struct.pack( "<BH", ord(o), len(chunk) ) + chunk for o, chunk in zip( ops, chunks ) ] )
+    
+    def writeMoves(self, xs, ys, zs, feedrates):
+        "Writes a G1 move record for each of the arrays' X, Y, Z and feed rate, without formatting them as text"
+        self.fh.write( self.encodeMoves( xs, ys, zs, feedrates ).tostring() )
+    
+    def encodeMoves(self, xs, ys, zs, feedrates):
+        records = numpy.empty( len(xs), self.move )
+        records['op'] = ord("M")
+        for field, values, scale in [ ( 'x', xs, 100 ), ( 'y', ys, 100 ), ( 'z', zs, 100 ), ( 'f', feedrates, 10 ) ]:
+            values = numpy.asarray( values, dtype=float )
+            fixed = self.roundFixed( values, scale )
+            fixed[ ( fixed == 0 ) & numpy.signbit( values ) ] = self.negative_zero
+            records[field] = fixed
+        return records
+    
+    def roundFixed(self, values, scale):
+        """
+        Returns values * scale rounded to whole numbers just as "%.2f" (scale 100) or "%.1f" (scale 10)
+        rounds values. Multiplying can round a value just off halfway onto it, so Dekker's method
+        finds the error in each product, which says which way those few should go.
+        """
+        product = values * scale
+        fixed = numpy.rint( product )
+        
+        split = values * 134217729.0    # 2**27 + 1
+        high = split - ( split - values )
+        error = ( high * scale - product ) + ( values - high ) * scale
+        
+        half = ( abs( product - fixed ) == 0.5 )
+        fixed[ half & ( error > 0 ) ] = numpy.floor( product[ half & ( error > 0 ) ] ) + 1
+        fixed[ half & ( error < 0 ) ] = numpy.floor( product[ half & ( error < 0 ) ] )
+        return fixed
+    
+    def finish(self):
+        "Writes any unterminated last line, as it is"
+        if self.pending:
+            self.fh.write( self.encodeText( self.pending, "C" ) )
+            self.pending = ""
+
+def makeShape(outputs):
+    "Generates the shape for each of the outputs, which differ only in their emboss factor"
+    global progress_start, progress_last
+    
+    progress_start = progress_last = time.time()
+    
+    first = args.startLayer or 1
+    lines = 0
+    
+    # The shape prints at the object's flow, as the base does. Adaptive layers vary it in proportion
+    # to their thickness.
+    shape_flow_rate = object_flow_rate * layer_flow_scale
+    flow_cmd = None
+    
+    writeAll( outputs, "(%s start)" % ( args.object_type.capitalize() ) )
+    
+    pos = getShapeXYZ( first, 0 )
+    if args.startLayer != None:
+        # Nothing has set up the flow, and the part is already on the bed: go up clear of it,
+        # across to the start of the layer, and only then down.
+        writeAll( outputs, "(Resuming at layer %d of %d)" % ( first, int(layerCount) - 1 ) )
+        if not args.adaptive:
+            writeAll( outputs, "%s S%.2f" % ( gcode_flow_cmd, shape_flow_rate ) )
+        writeAll( outputs, "G1 Z%.2f F%.1f" % ( pos[2] + resume_clearance, printer_base_move_rate ) )
+        writeAll( outputs, "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2] + resume_clearance, printer_base_move_rate ) )
+    writeAll( outputs, "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], printer_base_move_rate ) )
 
     if args.continuous:
         # Start extruding and don't stop until all layers are done
-        print "%s" % ( gcode_start_cmd )
+        writeAll( outputs, "%s" % ( gcode_start_cmd ) )
+    
+    layer = first - 1
+    reportProgress( 'start', layer, lines )
     
-    for layer in range( 1, int(layerCount) ):
+    for layer in range( first, int(layerCount) ):
+        if cancelled:
+            # Stop between layers, leaving the extruder at the start of the next layer
+            layer = layer - 1
+            writeAll( outputs, "(Cancelled after layer %d of %d)" % ( layer, int(layerCount) - 1 ) )
+            break
+        
+        indexSection( 'shape', layer, layerZ[layer] )
+        
+        if args.adaptive:
+            cmd = "%s S%.2f" % ( gcode_flow_cmd, shape_flow_rate * layerRise[layer - 1] / printer_layer_height )
+            if cmd != flow_cmd:
+                writeAll( outputs, cmd )
+                flow_cmd = cmd
+                lines = lines + 1
+        
         if not args.continuous:
             # Start extruding at the beginning of each layer
-            print "%s" % ( gcode_start_cmd )
+            writeAll( outputs, "%s" % ( gcode_start_cmd ) )
         
-        for segment in range(1, segments):
-            pos = getShapeXYZ( layer, segment )
-            value = getPixelValue( layer, segment )
-            
-            feedrate = printer_base_feed_rate - ( printer_base_feed_rate * ( ( 1 - value ) * ( 1 - args.embossFactor ) ) )
+        xs, ys, zs = getLayerXYZ( layer )
+        values = getLayerValues( layer )
+        
+        # The X, Y and Z of each move are the same for every output, so format them just once
+        if len(outputs) > 1:
+            moves = [ "G1 X%.2f Y%.2f Z%.2f F" % move for move in zip( xs, ys, zs ) ]
+        
+        for output in outputs:
+            feedrates = printer_base_feed_rate - ( printer_base_feed_rate * ( ( 1 - values ) * ( 1 - output['embossFactor'] ) ) )
             #
             # white pixel: value = 1.00; args.embossFactor = 0.60
             # feedrate = printer_base_feed_rate - ( printer_base_feed_rate * ( ( 1 - 1 ) * ( 1 - args.embossFactor ) ) )
@@ -460,61 +1813,184 @@ def makeShape():
             # feedrate = printer_base_feed_rate - ( printer_base_feed_rate * ( 1 - args.embossFactor ) )
             # feedrate = printer_base_feed_rate - ( printer_base_feed_rate * 0.4 )
             # feedrate = printer_base_feed_rate * 0.6
-             
-            print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], feedrate )
+            
+            if args.format == 'binary':
+                output['fh'].writeMoves( xs, ys, zs, feedrates )
+            elif len(outputs) > 1:
+                output['fh'].write( "".join( [ "%s%.1f\n" % move for move in zip( moves, feedrates.tolist() ) ] ) )
+            else:
+                output['fh'].write( "".join( [ "G1 X%.2f Y%.2f Z%.2f F%.1f\n" % move for move in zip( xs, ys, zs, feedrates.tolist() ) ] ) )
             
         if not args.continuous:
             # Stop extruding at the end of each layer
-            print "%s" % ( gcode_stop_cmd )
+            writeAll( outputs, "%s" % ( gcode_stop_cmd ) )
         
         pos = getShapeXYZ( layer + 1, 0 )
         if args.continuous:
-            value = getPixelValue( layer, segment )
-            feedrate = printer_base_feed_rate * ( 1 - ( ( 1 - args.embossFactor ) * value ) )
-            
-            print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], feedrate )
+            value = values[-1]
+            for output in outputs:
+                feedrate = printer_base_feed_rate * ( 1 - ( ( 1 - output['embossFactor'] ) * value ) )
+                
+                output['fh'].write( "G1 X%.2f Y%.2f Z%.2f F%.1f\n" % ( pos[0], pos[1], pos[2], feedrate ) )
         else:
-            print "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], printer_base_move_rate )
+            writeAll( outputs, "G1 X%.2f Y%.2f Z%.2f F%.1f" % ( pos[0], pos[1], pos[2], printer_base_move_rate ) )
+        
+        lines = lines + layerSegments[layer] + ( 0 if args.continuous else 2 )
+        reportProgress( 'layer', layer, lines )
         
     if args.continuous:
         # Stop extruding only once all layers are done
-        print "%s" % ( gcode_stop_cmd )
+        writeAll( outputs, "%s" % ( gcode_stop_cmd ) )
 
-    print "(%s end)" % ( args.object_type.capitalize() )
+    writeAll( outputs, "(%s end)" % ( args.object_type.capitalize() ) )
+    
+    reportProgress( 'cancelled' if cancelled else 'done', layer, lines )
 
 def getShapeXYZ( layer, segment ):
-    angle = anglePerSegment * segment
-
-    z = raft_iface_cruise_height + ( layer + args.bottomLayers ) * printer_layer_height
+    z = layerZ[layer]
     if args.continuous:
-        z = z + (printer_layer_height * (float(segment)/segments))
-    
-    if args.object_type   == 'cylinder':
-        r = args.radius
+        z = z + (layerRise[layer] * (float(segment)/layerSegments[layer]))
     
-    elif args.object_type == 'cone':
-        r = args.rBottomMm - ( ( args.rBottomMm - args.rTopMm ) * ( layer / layerCount ) )
+    r = layerRadius[layer]
+    dx, dy = getSegmentDirections( layerSegments[layer] )
     
-    elif args.object_type == 'globe':
-        layerH = ( ( layer / layerCount ) * args.heightMm ) - ( args.heightMm / 2 );
-        r = math.sqrt( abs ( math.pow( args.radius, 2 ) - math.pow( layerH, 2 ) ) );
-    
-    x = -math.sin(angle) * r
-    y = math.cos(angle) * r
+    x = dx[segment] * r
+    y = dy[segment] * r
     
     return ( x, y, z )
 
-init()
+def makePreview():
+    "Draws the shape's moves, coloured by feed rate, unrolled (angle across, layer up) and from above"
+    
+    start = time.time()
+    
+    # Gather every move of the shape into flat arrays, a layer at a time. Each move runs from
+    # segment k-1 to segment k of its layer.
+    layers = range( 1, int(layerCount) )
+    counts = [ layerSegments[layer] - 1 for layer in layers ]
+    moves  = sum( counts )
+    cols   = numpy.empty( moves, dtype=int )
+    rows   = numpy.empty( moves, dtype=int )
+    x0, y0, x1, y1 = [ numpy.empty( moves ) for i in range(4) ]
+    values = numpy.empty( moves )
+    
+    width  = preview_size
+    height = min( len(layers), preview_size )
+    
+    i = 0
+    for layer, count in zip( layers, counts ):
+        segs = layerSegments[layer]
+        dx, dy = getSegmentDirections( segs )
+        r = layerRadius[layer]
+        cols[i:i+count]   = numpy.arange( segs - 1 ) * width // segs
+        rows[i:i+count]   = ( height - 1 ) - ( layer - 1 ) * height // len(layers)
+        x0[i:i+count]     = dx[:-1] * r
+        y0[i:i+count]     = dy[:-1] * r
+        x1[i:i+count]     = dx[1:] * r
+        y1[i:i+count]     = dy[1:] * r
+        values[i:i+count] = getLayerValues( layer )
+        i = i + count
+    
+    feedrates = printer_base_feed_rate - ( printer_base_feed_rate * ( ( 1 - values ) * ( 1 - args.embossFactor ) ) )
+    
+    # Map the feed rates from the slowest the emboss factor allows up to the normal rate onto the colour ramp
+    slowest = printer_base_feed_rate * args.embossFactor
+    shades  = ( feedrates - slowest ) / max( printer_base_feed_rate - slowest, 1e-6 )
+    ramp    = numpy.array( preview_slow, dtype=float ) + numpy.outer( numpy.linspace( 0, 1, 256 ), numpy.subtract( preview_fast, preview_slow ) )
+    palette = numpy.vstack( ( ramp, [ 255, 255, 255 ] ) ).astype( numpy.uint8 )
+    
+    # Unrolled: one row per layer (up to preview_size) and preview_size columns around, averaging the
+    # moves which land on a pixel and carrying each across the columns up to the next, then stretched
+    # to the proportions of the shape's height and largest circumference
+    pixels = rows * width + cols
+    hits   = numpy.bincount( pixels, minlength=width*height )
+    total  = numpy.bincount( pixels, weights=shades, minlength=width*height )
+    colour = ( 255 * total / numpy.maximum( hits, 1 ) ).astype(int)
+    last   = numpy.where( hits > 0, numpy.arange( width*height ), 0 ).reshape( height, width )
+    colour = colour[ numpy.maximum.accumulate( last, axis=1 ) ]
+    
+    r_max  = max( layerRadius )
+    aspect = args.heightMm / ( 2 * math.pi * r_max )
+    unrolled = Image.fromarray( palette[colour] )
+    unrolled = unrolled.resize( ( width, max( 1, int( round( width * aspect ) ) ) ), Image.NEAREST )
+    unrolled.save( args.preview + "_unrolled.png" )
+    
+    # From above: every move is drawn as enough points to leave no gaps, and each pixel shows the
+    # last (and so highest) move over it, as numpy assigns repeated indices in order
+    size  = preview_size
+    scale = ( size - 1 ) / ( 2 * ( r_max + raft_margin ) )
+    points = int( math.ceil( numpy.hypot( x1 - x0, y1 - y0 ).max() * scale ) ) + 1
+    steps  = ( numpy.arange( 1, points + 1 ) / float( points ) ).astype( numpy.float32 )
+    
+    # Pixel coordinates are offset to be positive, so that truncating them rounds to the nearest
+    u = ( size // 2 + 0.5 + x0 * scale ).astype( numpy.float32 )[:,None] + numpy.outer( ( ( x1 - x0 ) * scale ).astype( numpy.float32 ), steps )
+    v = ( size // 2 + 0.5 - y0 * scale ).astype( numpy.float32 )[:,None] - numpy.outer( ( ( y1 - y0 ) * scale ).astype( numpy.float32 ), steps )
+    colour = numpy.empty( size * size, dtype=int )
+    colour.fill( 256 )
+    colour[ ( v.astype( numpy.int32 ) * size + u.astype( numpy.int32 ) ).ravel() ] = numpy.repeat( ( 255 * shades ).astype(int), points )
+    Image.fromarray( palette[colour].reshape( size, size, 3 ) ).save( args.preview + "_top.png" )
+    
+    if args.verbose > 0:
+        print >> sys.stderr, "Preview: %d moves, feed rates %.1f - %.1f, drawn in %.2fs." % ( moves, feedrates.min(), feedrates.max(), time.time() - start )
 
-for line in prefix:
-    print line
-        
-if ( raft_base_cruise_height > 0 ) or ( raft_iface_cruise_height > 0 ):
-    makeRaft()
+def generate(outputs):
+    "Writes the whole job to each of the outputs, which differ only in their emboss factor"
+    global layerIndex
+    
+    layerIndex = []
     
-makeBase()
+    # Everything before the shape is the same for every output, so generate it just once
+    stdout = sys.stdout
+    if len(outputs) > 1:
+        sys.stdout = StringIO.StringIO()
+    else:
+        sys.stdout = outputs[0]['fh']
+    
+    indexSection( 'prefix', 0, 0.0 )
+    for line in prefix:
+        print line
+    
+    if args.startLayer == None:
+        makeRaft()
+        makeBase()
+    
+    if len(outputs) > 1:
+        common = sys.stdout.getvalue()
+        for output in outputs:
+            output['fh'].write( common )
+    sys.stdout = stdout
+    
+    makeShape( outputs )
+    
+    indexSection( 'suffix', 0, 0.0 )
+    for line in suffix:
+        writeAll( outputs, line )
+    
+    for output in outputs:
+        if args.checksum or ( args.format != 'text' ):
+            output['fh'].finish()
+        output['fh'].flush()
+    if args.index:
+        writeIndex()
 
-makeShape()
+def main(argv=None):
+    init(argv)
+    
+    if args.preview != None:
+        makePreview()
+    elif sweeping():
+        runSweep()
+    else:
+        sys.stdout = openOutput( sys.stdout )
+        generate( [ { 'embossFactor': args.embossFactor, 'fh': sys.stdout } ] )
+    
+    sys.stdout = sys.__stdout__
+    
+    if cancelled:
+        print >> sys.stderr, "Cancelled. The output is complete up to the last finished layer."
+        exit(1)
 
-for line in suffix:
-    print line
\ No newline at end of file
+if __name__ == '__main__':
+    signal.signal( signal.SIGINT,  cancel )
+    signal.signal( signal.SIGTERM, cancel )
+    main()
\ No newline at end of file
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Copyright 2012 Digiknit Ltd (mike@digiknit.com)
+
+# GNU Copyleft Statement
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage:
+#        regress.py [-h] -r REFERENCE [-C CANDIDATE] [-a CANDIDATE_ARGS]
+#                   [-c CONFIG] [-p PREFIX] [-s SUFFIX] [-t TOLERANCE]
+#                   [-f FEED_TOLERANCE] [-m MAX_REPORT] [-q] [-v]
+#
+# Differential regression harness. Runs a reference copy of emboss.py and a
+# candidate copy over a matrix of shapes, images and options, parses both
+# outputs as move streams and compares them within a tolerance. Throughput
+# of both is reported side by side.
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -r REFERENCE, --reference REFERENCE
+#                         the emboss.py to treat as the known good output
+#   -C CANDIDATE, --candidate CANDIDATE
+#                         the emboss.py under test (default ./emboss.py)
+#   -a CANDIDATE_ARGS, --candidate-args CANDIDATE_ARGS
+#                         extra options passed only to the candidate
+#   -t TOLERANCE, --tolerance TOLERANCE
+#                         maximum X/Y/Z difference in mm
+#   -f FEED_TOLERANCE, --feed-tolerance FEED_TOLERANCE
+#                         maximum F difference in mm/min
+#   -m MAX_REPORT, --max-report MAX_REPORT
+#                         number of mismatching lines to show per case
+#   -q, --quick           run a reduced matrix
+#   -v, --verbose         set verbosity -v -vv -vvv etc
+
+# Usage example
+# git show HEAD~1:Unix_Mac/emboss.py > /tmp/reference.py
+# ./regress.py --reference /tmp/reference.py
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import Image
+
+# Test matrix. Each entry is (label, options placed before the shape, shape and its options)
+matrix_shapes = [
+    ( "cylinder", [ "cylinder", "--radius", "20.0" ] ),
+    ( "cone",     [ "cone", "--rbot", "30.0", "--rtop", "20.0" ] ),
+    ( "globe",    [ "globe" ] ),
+]
+
+matrix_images = [ "globe.png", "bfblogo.png", "hgradient", "vgradient" ]
+
+matrix_options = [
+    ( "default",  [] ),
+    ( "zsmooth",  [ "--zsmooth" ] ),
+    ( "base2",    [ "--bottomLayers", "2" ] ),
+    ( "emboss80", [ "--embossFactor", "0.80" ] ),
+    ( "short",    [ "--height", "20", "--zsmooth" ] ),
+]
+
+quick_images  = [ "globe.png", "hgradient" ]
+quick_options = [ "default", "zsmooth" ]
+
+def getConfigFromArgs():
+    global args
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="""
+        Compare the moves generated by a candidate emboss.py against a reference emboss.py over a
+        matrix of shapes, images and options.
+    """)
+
+    parser.add_argument("-r", "--reference", dest="reference", required=True, help="the emboss.py to treat as the known good output")
+    parser.add_argument("-C", "--candidate", dest="candidate", default=os.path.join(here, "emboss.py"), help="the emboss.py under test (default ./emboss.py)")
+    parser.add_argument("-a", "--candidate-args", dest="candidate_args", default="", help="extra options passed only to the candidate")
+
+    parser.add_argument("-c", "--config", dest="config", default=os.path.join(here, "BfB3000_config.txt"))
+    parser.add_argument("-p", "--prefix", dest="prefix", default=os.path.join(here, "BfB3000_prefix.txt"))
+    parser.add_argument("-s", "--suffix", dest="suffix", default=os.path.join(here, "BfB3000_suffix.txt"))
+
+    parser.add_argument("-t", "--tolerance", type=float, dest="tolerance", help="maximum X/Y/Z difference in mm", default=0.011)
+    parser.add_argument("-f", "--feed-tolerance", type=float, dest="feed_tolerance", help="maximum F difference in mm/min", default=0.11)
+    parser.add_argument("-m", "--max-report", type=int, dest="max_report", help="number of mismatching lines to show per case", default=5)
+    parser.add_argument("-q", "--quick", action="store_true", dest="quick", help="run a reduced matrix", default=False)
+
+    parser.add_argument("-v", "--verbose", action="count", dest="verbose", help="set verbosity -v -vv -vvv etc", default=0)
+
+    args = parser.parse_args()
+    args.here = here
+
+def makeGradientImage(filename, orientation):
+    "Writes a synthetic black to white gradient, running left to right or bottom to top"
+
+    width, height = 400, 160
+    im = Image.new("L", ( width, height ))
+
+    if orientation == 'h':
+        im.putdata( [ ( 255 * x ) // ( width - 1 ) for y in range(height) for x in range(width) ] )
+    else:
+        im.putdata( [ ( 255 * ( height - 1 - y ) ) // ( height - 1 ) for y in range(height) for x in range(width) ] )
+
+    im.save(filename)
+
+def getImagePath(name):
+    if name == "hgradient" or name == "vgradient":
+        path = os.path.join( workdir, name + ".png" )
+        if not os.path.exists(path):
+            makeGradientImage( path, name[0] )
+        return path
+    return os.path.join( args.here, name )
+
+def runEmboss(script, image, options, shape, output, extra=[]):
+    "Runs one copy of emboss.py, returning the elapsed time in seconds"
+
+    command = [ sys.executable, script,
+                "--config", args.config, "--prefix", args.prefix, "--suffix", args.suffix,
+                "--image", image, "--output", output ] + extra + options + shape
+
+    if args.verbose > 1:
+        print >> sys.stderr, " ".join(command)
+
+    start = time.time()
+    status = subprocess.call( command )
+    elapsed = time.time() - start
+
+    if status != 0:
+        raise RuntimeError( "%s exited with status %d" % ( script, status ) )
+
+    return elapsed
+
+def parseMoves(filename):
+    "Returns the output as a list of ('G1', x, y, z, f) moves and ('CMD', text) lines"
+
+    moves = []
+    x = y = z = f = None
+
+    for line in open(filename):
+        line = line.strip()
+        if not line:
+            continue
+
+        words = line.split()
+        if words[0] == 'G1':
+            for word in words[1:]:
+                axis = word[0]
+                if   axis == 'X': x = float(word[1:])
+                elif axis == 'Y': y = float(word[1:])
+                elif axis == 'Z': z = float(word[1:])
+                elif axis == 'F': f = float(word[1:])
+            moves.append( ( 'G1', x, y, z, f ) )
+        else:
+            moves.append( ( 'CMD', line ) )
+
+    return moves
+
+def compareMoves(reference, candidate):
+    "Returns a list of (index, reference, candidate) tuples which differ"
+
+    mismatches = []
+
+    for i in range( min( len(reference), len(candidate) ) ):
+        r = reference[i]
+        c = candidate[i]
+
+        if r[0] != c[0]:
+            mismatches.append( ( i, r, c ) )
+        elif r[0] == 'CMD':
+            if r[1] != c[1]:
+                mismatches.append( ( i, r, c ) )
+        else:
+            for axis in range( 1, 4 ):
+                if abs( r[axis] - c[axis] ) > args.tolerance:
+                    mismatches.append( ( i, r, c ) )
+                    break
+            else:
+                if abs( r[4] - c[4] ) > args.feed_tolerance:
+                    mismatches.append( ( i, r, c ) )
+
+    if len(reference) != len(candidate):
+        i = min( len(reference), len(candidate) )
+        mismatches.append( ( i, reference[i:i+1], candidate[i:i+1] ) )
+
+    return mismatches
+
+def runCase(label, image, options, shape):
+    global failures
+
+    ref_output = os.path.join( workdir, "reference.bfb" )
+    can_output = os.path.join( workdir, "candidate.bfb" )
+
+    ref_time = runEmboss( args.reference, image, options, shape, ref_output )
+    can_time = runEmboss( args.candidate, image, options, shape, can_output, shlex.split(args.candidate_args) )
+
+    reference = parseMoves(ref_output)
+    candidate = parseMoves(can_output)
+
+    mismatches = compareMoves( reference, candidate )
+
+    lines = len(reference)
+    print "%-36s %9d %9d %10.0f %10.0f %6.2fx  %s" % ( label, lines, len(candidate),
+        lines / max( ref_time, 1e-6 ), len(candidate) / max( can_time, 1e-6 ),
+        ref_time / max( can_time, 1e-6 ), "ok" if not mismatches else "FAIL (%d)" % len(mismatches) )
+
+    for i, r, c in mismatches[:args.max_report]:
+        print "    line %d:" % ( i + 1 )
+        print "        reference: %s" % ( r, )
+        print "        candidate: %s" % ( c, )
+
+    if mismatches:
+        failures = failures + 1
+
+    return ref_time, can_time
+
+getConfigFromArgs()
+
+workdir = tempfile.mkdtemp( prefix="regress" )
+failures = 0
+total_ref = 0.0
+total_can = 0.0
+
+images  = matrix_images
+options = matrix_options
+if args.quick:
+    images  = quick_images
+    options = [ o for o in matrix_options if o[0] in quick_options ]
+
+print "%-36s %9s %9s %10s %10s %7s  %s" % ( "case", "ref lines", "can lines", "ref l/s", "can l/s", "speed", "result" )
+
+try:
+    for shape_label, shape in matrix_shapes:
+        for image_name in images:
+            for option_label, option in options:
+                label = "%s/%s/%s" % ( shape_label, os.path.splitext(image_name)[0], option_label )
+                try:
+                    ref_time, can_time = runCase( label, getImagePath(image_name), option, shape )
+                except RuntimeError, msg:
+                    print "%-36s %s" % ( label, msg )
+                    failures = failures + 1
+                    continue
+                total_ref = total_ref + ref_time
+                total_can = total_can + can_time
+finally:
+    shutil.rmtree(workdir)
+
+print "Total time: reference %.2fs, candidate %.2fs (%.2fx)" % ( total_ref, total_can, total_ref / max( total_can, 1e-6 ) )
+
+if failures > 0:
+    print "%d case(s) differ from the reference." % ( failures )
+    exit(1)